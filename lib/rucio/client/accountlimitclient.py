@@ -24,28 +24,111 @@
 # - Eli Chadwick <eli.chadwick@stfc.ac.uk>, 2020
 # - Benedikt Ziemons <benedikt.ziemons@cern.ch>, 2021
 
-from json import dumps
+import string
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from random import choice
+
+try:
+    from urllib.parse import quote_plus
+except ImportError:
+    from urllib import quote_plus  # py2
 
 from requests.status_codes import codes
-from six.moves.urllib.parse import quote_plus
+from six import integer_types
 
 from rucio.client.baseclient import BaseClient
-from rucio.client.baseclient import choice
+from rucio.common.exception import InputValidationError, UnsupportedOperation
 from rucio.common.utils import build_url
 
+_CREATED = codes.created
+_OK = codes.ok
+_LOCALITIES = frozenset(('local', 'global'))
+# characters left unchanged by quote_plus on every supported python version
+_SAFE_CHARACTERS = frozenset(string.ascii_letters + string.digits + '_.-')
+
+
+def _quote_rse_expression(rse_expression):
+    """
+    Quotes an rse expression for the url path. Plain rse names, the common case, are returned as they are.
+
+    :param rse_expression: The rse expression.
+    :return: The quoted rse expression.
+    """
+    if _SAFE_CHARACTERS.issuperset(rse_expression):
+        return rse_expression
+    return quote_plus(rse_expression)
+
+
+class _WriteDedupCache(object):
+    """
+    Bounded cache of the last value written per key. The entries expire after expiration_time seconds and,
+    once maxsize entries are kept, the oldest written entry is evicted.
+    """
+
+    def __init__(self, maxsize, expiration_time):
+        self._maxsize = maxsize
+        self._expiration_time = expiration_time
+        # key -> (value, expiration epoch), in the order of the writes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            value, expiration = self._entries.get(key, (None, None))
+            if expiration is not None and expiration <= time.time():
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, now + self._expiration_time)
+            # all the entries live as long, so the expired ones are the oldest
+            while self._entries and (len(self._entries) > self._maxsize or next(iter(self._entries.values()))[1] <= now):
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
 
 class AccountLimitClient(BaseClient):
 
     """Account limit client class for working with account limits"""
 
     ACCOUNTLIMIT_BASEURL = 'accountlimits'
+    _LOCAL_PREFIX = ACCOUNTLIMIT_BASEURL + '/local/'
+    _GLOBAL_PREFIX = ACCOUNTLIMIT_BASEURL + '/global/'
+    # (http request type, locality) -> (path prefix, expected status code)
+    _OPERATIONS = {('POST', 'local'): (_LOCAL_PREFIX, _CREATED),
+                   ('POST', 'global'): (_GLOBAL_PREFIX, _CREATED),
+                   ('DEL', 'local'): (_LOCAL_PREFIX, _OK),
+                   ('DEL', 'global'): (_GLOBAL_PREFIX, _OK)}
+    WRITE_DEDUP_EXPIRATION_TIME, WRITE_DEDUP_MAXSIZE = 10, 1024
 
     def __init__(self, rucio_host=None, auth_host=None, account=None, ca_cert=None,
-                 auth_type=None, creds=None, timeout=600, user_agent='rucio-clients', vo=None):
+                 auth_type=None, creds=None, timeout=600, user_agent='rucio-clients', vo=None,
+                 enable_write_dedup=False):
         super(AccountLimitClient, self).__init__(rucio_host, auth_host, account, ca_cert,
                                                  auth_type, creds, timeout, user_agent, vo=vo)
-
-    def set_account_limit(self, account, rse, bytes_, locality):
+        # the host is chosen once per client, request urls are then built by concatenation
+        self._base_url = build_url(choice(self.list_hosts), path='')
+        self._url_prefixes = dict((operation, (self._base_url + prefix, expected_status_code))
+                                  for operation, (prefix, expected_status_code) in self._OPERATIONS.items())
+        # with enable_write_dedup, setting a limit to the value this client has just set is not sent again to the server
+        self._last_set = None
+        if enable_write_dedup:
+            self._last_set = _WriteDedupCache(maxsize=self.WRITE_DEDUP_MAXSIZE, expiration_time=self.WRITE_DEDUP_EXPIRATION_TIME)
+
+    def set_account_limit(self, account, rse, bytes_, locality, return_response=False):
         """
         Sets an account limit for a given limit scope.
 
@@ -53,119 +136,173 @@ class AccountLimitClient(BaseClient):
         :param rse:     The rse name.
         :param bytes_:   An integer with the limit in bytes.
         :param locality: The scope of the account limit. 'local' or 'global'.
+        :param return_response: If True, the http response is returned instead of True.
         :return:        True if quota was created successfully else False.
         """
 
-        if locality == 'local':
-            return self.set_local_account_limit(account, rse, bytes_)
-        elif locality == 'global':
-            return self.set_global_account_limit(account, rse, bytes_)
-        else:
-            from rucio.common.exception import UnsupportedOperation
+        if locality not in _LOCALITIES:
             raise UnsupportedOperation('The provided scope (%s) for the account limit was invalid' % locality)
+        return self._send_account_limit_request('POST', locality, account, rse, bytes_, return_response=return_response)
 
-    def delete_account_limit(self, account, rse, locality):
+    def delete_account_limit(self, account, rse, locality, return_response=False):
         """
         Deletes an account limit for a given limit scope.
 
         :param account: The name of the account.
         :param rse:     The rse name.
         :param locality: The scope of the account limit. 'local' or 'global'.
+        :param return_response: If True, the http response is returned instead of True.
         :return:        True if quota was created successfully else False.
         """
 
-        if locality == 'local':
-            return self.delete_local_account_limit(account, rse)
-        elif locality == 'global':
-            return self.delete_global_account_limit(account, rse)
-        else:
-            from rucio.common.exception import UnsupportedOperation
+        if locality not in _LOCALITIES:
             raise UnsupportedOperation('The provided scope (%s) for the account limit was invalid' % locality)
+        return self._send_account_limit_request('DEL', locality, account, rse, return_response=return_response)
+
+    def set_account_limits_bulk(self, items, max_workers=16):
+        """
+        Sets several account limits concurrently. The order in which the limits are set is not specified.
+
+        :param items:       A list of (account, rse, bytes_, locality) tuples.
+        :param max_workers: The maximum number of concurrent requests.
+        :return:            A list with, for each item, True if the limit was set or the exception raised while setting it.
+        """
+
+        return self._run_bulk(self.set_account_limit, items, max_workers)
+
+    def delete_account_limits_bulk(self, items, max_workers=16):
+        """
+        Deletes several account limits concurrently. The order in which the limits are deleted is not specified.
 
-    def set_local_account_limit(self, account, rse, bytes_):
+        :param items:       A list of (account, rse, locality) tuples.
+        :param max_workers: The maximum number of concurrent requests.
+        :return:            A list with, for each item, True if the limit was deleted or the exception raised while deleting it.
+        """
+
+        return self._run_bulk(self.delete_account_limit, items, max_workers)
+
+    def _run_bulk(self, function, items, max_workers):
+        """
+        Helper method to call a function for each item in a pool of threads sharing the client session.
+        The number of threads is capped at the size of the connection pool, so that every concurrent
+        request gets a kept-alive connection instead of opening, and then discarding, an extra one.
+
+        :param function:    The function to call with the unpacked item.
+        :param items:       A list of argument tuples.
+        :param max_workers: The maximum number of threads.
+        :return:            A list with, for each item, the return value of the function or the exception it raised.
+        """
+
+        items = list(items)
+        if not items:
+            return []
+
+        def call(args):
+            try:
+                return function(*args)
+            except Exception as error:
+                return error
+
+        pool = ThreadPool(min(max_workers, self.POOL_MAXSIZE, len(items)))
+        try:
+            return pool.map(call, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def set_local_account_limit(self, account, rse, bytes_, return_response=False):
         """
         Sends the request to set an account limit for an account.
 
         :param account: The name of the account.
         :param rse:     The rse name.
         :param bytes_:   An integer with the limit in bytes.
+        :param return_response: If True, the http response is returned instead of True.
         :return:        True if quota was created successfully else False.
         """
 
-        data = dumps({'bytes': bytes_})
-        path = '/'.join([self.ACCOUNTLIMIT_BASEURL, 'local', account, rse])
-        url = build_url(choice(self.list_hosts), path=path)
-
-        r = self._send_request(url, type_='POST', data=data)
+        return self._send_account_limit_request('POST', 'local', account, rse, bytes_, return_response=return_response)
 
-        if r.status_code == codes.created:
-            return True
-        else:
-            exc_cls, exc_msg = self._get_exception(headers=r.headers, status_code=r.status_code, data=r.content)
-            raise exc_cls(exc_msg)
-
-    def delete_local_account_limit(self, account, rse):
+    def delete_local_account_limit(self, account, rse, return_response=False):
         """
         Sends the request to remove an account limit.
 
         :param account: The name of the account.
         :param rse:     The rse name.
+        :param return_response: If True, the http response is returned instead of True.
 
         :return: True if quota was removed successfully. False otherwise.
         :raises AccountNotFound: if account doesn't exist.
         """
 
-        path = '/'.join([self.ACCOUNTLIMIT_BASEURL, 'local', account, rse])
-        url = build_url(choice(self.list_hosts), path=path)
-
-        r = self._send_request(url, type_='DEL')
+        return self._send_account_limit_request('DEL', 'local', account, rse, return_response=return_response)
 
-        if r.status_code == codes.ok:
-            return True
-        else:
-            exc_cls, exc_msg = self._get_exception(headers=r.headers, status_code=r.status_code, data=r.content)
-            raise exc_cls(exc_msg)
-
-    def set_global_account_limit(self, account, rse_expression, bytes_):
+    def set_global_account_limit(self, account, rse_expression, bytes_, return_response=False):
         """
         Sends the request to set a global account limit for an account.
 
         :param account:        The name of the account.
         :param rse_expression: The rse expression.
         :param bytes_:          An integer with the limit in bytes.
+        :param return_response: If True, the http response is returned instead of True.
         :return:               True if quota was created successfully else False.
         """
 
-        data = dumps({'bytes': bytes_})
-        path = '/'.join([self.ACCOUNTLIMIT_BASEURL, 'global', account, quote_plus(rse_expression)])
-        url = build_url(choice(self.list_hosts), path=path)
+        return self._send_account_limit_request('POST', 'global', account, rse_expression, bytes_, return_response=return_response)
 
-        r = self._send_request(url, type_='POST', data=data)
-
-        if r.status_code == codes.created:
-            return True
-        else:
-            exc_cls, exc_msg = self._get_exception(headers=r.headers, status_code=r.status_code, data=r.content)
-            raise exc_cls(exc_msg)
-
-    def delete_global_account_limit(self, account, rse_expression):
+    def delete_global_account_limit(self, account, rse_expression, return_response=False):
         """
         Sends the request to remove a global account limit.
 
         :param account:        The name of the account.
         :param rse_expression: The rse expression.
+        :param return_response: If True, the http response is returned instead of True.
 
         :return: True if quota was removed successfully. False otherwise.
         :raises AccountNotFound: if account doesn't exist.
         """
 
-        path = '/'.join([self.ACCOUNTLIMIT_BASEURL, 'global', account, quote_plus(rse_expression)])
-        url = build_url(choice(self.list_hosts), path=path)
+        return self._send_account_limit_request('DEL', 'global', account, rse_expression, return_response=return_response)
+
+    def _send_account_limit_request(self, type_, locality, account, rse, bytes_=None, return_response=False):
+        """
+        Helper method to send the request to set ('POST') or remove ('DEL') an account limit.
 
-        r = self._send_request(url, type_='DEL')
+        :param type_:    The http request type to use, 'POST' or 'DEL'.
+        :param locality: The scope of the account limit. 'local' or 'global'.
+        :param account:  The name of the account.
+        :param rse:      The rse name for a local limit, the rse expression for a global limit.
+        :param bytes_:   An integer with the limit in bytes, only used with 'POST'.
+        :param return_response: If True, the http response is returned instead of True. The request is then
+                                always sent, even if the write deduplication would skip it.
+        :return:         True, or the http response with return_response, if the request was successful.
+        :raises InputValidationError: if bytes_ is not an integer.
+        """
 
-        if r.status_code == codes.ok:
-            return True
+        url_prefix, expected_status_code = self._url_prefixes[(type_, locality)]
+        key = '%s:%s:%s' % (locality, account, rse)
+        if type_ == 'POST':
+            if not isinstance(bytes_, integer_types):
+                raise InputValidationError('The account limit must be an integer, got %r' % (bytes_,))
+            if self._last_set is not None and not return_response and self._last_set.get(key) == bytes_:
+                return True
+            # the body has a single integer field, there is no need to go through a json encoder
+            data = '{"bytes": %d}' % bytes_
         else:
+            if self._last_set is not None:
+                self._last_set.delete(key)
+            data = None
+
+        if locality == 'global':
+            rse = _quote_rse_expression(rse)
+        r = self._send_request(url_prefix + account + '/' + rse, type_=type_, data=data)
+
+        if r.status_code != expected_status_code:
             exc_cls, exc_msg = self._get_exception(headers=r.headers, status_code=r.status_code, data=r.content)
             raise exc_cls(exc_msg)
+
+        if type_ == 'POST' and self._last_set is not None:
+            self._last_set.set(key, bytes_)
+        if return_response:
+            return r
+        return True
@@ -44,67 +44,153 @@
 
 from __future__ import print_function
 
+import base64
+import binascii
 import errno
+import json
 import os
 import random
+import socket
 import sys
+import threading
 import time
-from os import environ, fdopen, path, makedirs, geteuid
-from shutil import move
+from email.utils import mktime_tz, parsedate_tz
+from os import environ, fdopen, path, makedirs, geteuid, rename
 from tempfile import mkstemp
 
-from dogpile.cache import make_region
 from requests import Session, Response
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError
 from requests.status_codes import codes
+from six.moves import input
 from six.moves.configparser import NoOptionError, NoSectionError
-from six.moves.urllib.parse import urlparse
+from urllib3.connection import HTTPConnection
+from urllib3.exceptions import MaxRetryError
+from urllib3.util.retry import Retry
 
 from rucio import version
 from rucio.common import exception
 from rucio.common.config import config_get, config_get_bool, config_get_int
 from rucio.common.exception import (CannotAuthenticate, ClientProtocolNotSupported,
                                     NoAuthInformation, MissingClientParameter,
-                                    MissingModuleException, ServerConnectionException)
+                                    MissingModuleException, ServerConnectionException, UnsupportedOperation)
 from rucio.common.extra import import_extras
-from rucio.common.utils import build_url, get_tmp_dir, my_key_generator, parse_response, ssh_sign, setup_logger
-
-EXTRA_MODULES = import_extras(['requests_kerberos'])
-
-if EXTRA_MODULES['requests_kerberos']:
-    from requests_kerberos import HTTPKerberosAuth  # pylint: disable=import-error
+from rucio.common.utils import build_url, get_tmp_dir, parse_response, ssh_sign, setup_logger
 
 LOG = setup_logger(module_name=__name__)
 
-REGION = make_region(function_key_generator=my_key_generator).configure(
-    'dogpile.cache.memory',
-    expiration_time=60,
-)
+CHOSEN_HOSTS = {}
 
-STATUS_CODES_TO_RETRY = [502, 503, 504]
+STATUS_CODES_TO_RETRY = frozenset((502, 503, 504))
+VALID_AUTH_TYPES = frozenset(('userpass', 'x509', 'x509_proxy', 'gss', 'ssh', 'saml', 'oidc'))
 MAX_RETRY_BACK_OFF_SECONDS = 10
+# urllib3 already disables Nagle's algorithm, TCP keep-alive probes are added to keep the idle pooled connections open
+SOCKET_OPTIONS = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+if hasattr(socket, 'TCP_KEEPIDLE'):
+    SOCKET_OPTIONS.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60))
 
 
-def back_off(retry_number, reason):
+def retry_after_seconds(retry_after):
+    """
+    Parses the value of a Retry-After header, which is either a number of seconds or an HTTP date.
+    :param retry_after: the value of the header, or None
+    :returns: the number of seconds to wait, negative for a date in the past, or None if the value is missing or malformed
     """
-    Sleep a certain amount of time which increases with the retry count
+    if retry_after is None:
+        return None
+    retry_after = retry_after.strip()
+    if retry_after.isdigit():
+        return int(retry_after)
+    date = parsedate_tz(retry_after)
+    if date is None:
+        return None
+    try:
+        return mktime_tz(date) - time.time()
+    except (OverflowError, ValueError):
+        return None
+
+
+def back_off(retry_number, reason, retry_after=None):
+    """
+    Sleep a certain amount of time which increases with the retry count. The time is jittered,
+    so that clients failing at the same moment do not all retry at the same moment.
     :param retry_number: the retry iteration
     :param reason: the reason to backoff which will be shown to the user
+    :param retry_after: the value of the Retry-After header of the response, if any
     """
-    sleep_time = min(MAX_RETRY_BACK_OFF_SECONDS, 0.25 * 2 ** retry_number)
+    sleep_time = retry_after_seconds(retry_after)
+    if sleep_time is None:
+        sleep_time = min(MAX_RETRY_BACK_OFF_SECONDS, 0.25 * 2 ** retry_number)
+        sleep_time = random.uniform(sleep_time / 2, sleep_time)
+    else:
+        sleep_time = min(MAX_RETRY_BACK_OFF_SECONDS, max(0, sleep_time))
     LOG.warning("Waiting {}s due to reason: {} ".format(sleep_time, reason))
     time.sleep(sleep_time)
 
 
-@REGION.cache_on_arguments(namespace='host_to_choose')
+def _header_message_is_exact(message):
+    """
+    Checks if an exception message from the response headers is the same as the one of the response body.
+    The server replaces the line breaks of the headers by spaces and truncates the long messages with '...',
+    and the headers only carry ASCII characters reliably.
+    :param message: the ExceptionMessage header, or None
+    :returns: True if the message cannot have been altered in the headers
+    """
+    if message is None or ' ' in message or message.endswith('...'):
+        return False
+    try:
+        message.encode('ascii')
+    except UnicodeError:
+        return False
+    return True
+
+
+def url_scheme(url):
+    """
+    Returns the scheme of an url, without parsing the rest of it
+    :param url: the url
+    :returns: the lower case scheme, or an empty string if the url has none
+    """
+    if '://' not in url:
+        return ''
+    return url.split('://', 1)[0].lower()
+
+
+def jwt_expiration(token):
+    """
+    Returns the expiration time of a JSON Web Token, without verifying it
+    :param token: the token
+    :returns: the exp claim as an epoch, or None if the token is not a JWT or has no expiration
+    """
+    try:
+        payload = token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(str(payload + '=' * (-len(payload) % 4))).decode('utf-8'))
+        return int(claims['exp'])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError, binascii.Error):
+        return None
+
+
 def choice(hosts):
     """
-    Select randomly a host
+    Select randomly a host. The host selected for a list of hosts is then kept for the lifetime of the process.
 
     :param hosts: Lost of hosts
     :return: A randomly selected host.
     """
-    return random.choice(hosts)
+    key = tuple(hosts)
+    try:
+        return CHOSEN_HOSTS[key]
+    except KeyError:
+        return CHOSEN_HOSTS.setdefault(key, random.choice(hosts))
+
+
+class KeepAliveHTTPAdapter(HTTPAdapter):
+
+    """HTTP adapter setting the SOCKET_OPTIONS on the connections of its pool."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.setdefault('socket_options', SOCKET_OPTIONS)
+        super(KeepAliveHTTPAdapter, self).init_poolmanager(*args, **kwargs)
 
 
 class BaseClient(object):
@@ -112,9 +198,21 @@ class BaseClient(object):
     """Main client class for accessing Rucio resources. Handles the authentication."""
 
     AUTH_RETRIES, REQUEST_RETRIES = 2, 3
+    POOL_CONNECTIONS, POOL_MAXSIZE = 32, 32
+    CONNECT_RETRIES, CONNECT_BACKOFF_FACTOR = 3, 0.2
+    HTTP_METHODS = {'GET': 'GET', 'PUT': 'PUT', 'POST': 'POST', 'DEL': 'DELETE'}
+    # auth type -> (credentials which must be set, error message if one is missing)
+    AUTH_REQUIRED_CREDS = {'userpass': (('username', 'password'), 'No username or password passed'),
+                           'x509': (('client_cert',), 'The path to the client certificate is required'),
+                           'x509_proxy': (('client_proxy',), 'The client proxy has to be defined'),
+                           'ssh': (('ssh_private_key',), 'The SSH private key has to be defined'),
+                           'gss': ((), None),
+                           'saml': (('username', 'password'), 'No SAML username or password passed'),
+                           'oidc': (('oidc_username', 'oidc_password'), 'For automatic OIDC log-in with your Identity Provider username and password are required.')}
     TOKEN_PATH_PREFIX = get_tmp_dir() + '/.rucio_'
     TOKEN_PREFIX = 'auth_token_'
     TOKEN_EXP_PREFIX = 'auth_token_exp_'
+    TOKEN_EXPIRATION_MARGIN = 60
 
     def __init__(self, rucio_host=None, auth_host=None, account=None, ca_cert=None, auth_type=None, creds=None, timeout=600, user_agent='rucio-clients', vo=None):
         """
@@ -135,9 +233,9 @@ class BaseClient(object):
         self.host = rucio_host
         self.list_hosts = []
         self.auth_host = auth_host
-        self.session = Session()
+        self.session = self._create_session()
         self.user_agent = "%s/%s" % (user_agent, version.version_string())  # e.g. "rucio-clients/0.2.13"
-        sys.argv[0] = sys.argv[0].split('/')[-1]
+        sys.argv[0] = path.basename(sys.argv[0])
         self.script_id = '::'.join(sys.argv[0:2])
         if self.script_id == '':  # Python interpreter used
             self.script_id = 'python'
@@ -161,12 +259,20 @@ class BaseClient(object):
         self.auth_type = auth_type
         self.creds = creds
         self.auth_token = None
+        # serializes the token refreshes of threads sharing this client
+        self._token_lock = threading.RLock()
+        # set while a token is being fetched, the requests of the token flows must not start another refresh
+        self._refreshing_token = False
+        # (token, its expiration epoch), the expiration is only decoded once per token
+        self._token_expiration = (None, None)
         self.auth_token_file_path = config_get('client', 'auth_token_file_path', False, None)
         self.headers = {}
+        self.base_headers = None
         self.timeout = timeout
         self.request_retries = self.REQUEST_RETRIES
         self.token_exp_epoch = None
         self.token_exp_epoch_file = None
+        self.token_exp_epoch_file_mtime = None
         self.auth_oidc_refresh_active = config_get_bool('client', 'auth_oidc_refresh_active', False, False)
         # defining how many minutes before token expires, oidc refresh (if active) should start
         self.auth_oidc_refresh_before_exp = config_get_int('client', 'auth_oidc_refresh_before_exp', False, 20)
@@ -174,7 +280,7 @@ class BaseClient(object):
         if auth_type is None:
             LOG.debug('No auth_type passed. Trying to get it from the environment variable RUCIO_AUTH_TYPE and config file.')
             if 'RUCIO_AUTH_TYPE' in environ:
-                if environ['RUCIO_AUTH_TYPE'] not in ['userpass', 'x509', 'x509_proxy', 'gss', 'ssh', 'saml', 'oidc']:
+                if environ['RUCIO_AUTH_TYPE'] not in VALID_AUTH_TYPES:
                     raise MissingClientParameter('Possible RUCIO_AUTH_TYPE values: userpass, x509, x509_proxy, gss, ssh, saml, oidc, vs. ' + environ['RUCIO_AUTH_TYPE'])
                 self.auth_type = environ['RUCIO_AUTH_TYPE']
             else:
@@ -217,12 +323,13 @@ class BaseClient(object):
                     if not path.exists(self.creds['client_cert']):
                         raise MissingClientParameter('X.509 client certificate not found: %s' % self.creds['client_cert'])
                     self.creds['client_key'] = path.abspath(path.expanduser(path.expandvars(config_get('client', 'client_key'))))
-                    if not path.exists(self.creds['client_key']):
-                        raise MissingClientParameter('X.509 client key not found: %s' % self.creds['client_key'])
-                    else:
+                    try:
+                        # a single stat tells both if the key exists and its permissions
                         perms = oct(os.stat(self.creds['client_key']).st_mode)[-3:]
-                        if perms != '400':
-                            raise CannotAuthenticate('X.509 authentication selected, but private key (%s) permissions are liberal (required: 400, found: %s)' % (self.creds['client_key'], perms))
+                    except OSError:
+                        raise MissingClientParameter('X.509 client key not found: %s' % self.creds['client_key'])
+                    if perms != '400':
+                        raise CannotAuthenticate('X.509 authentication selected, but private key (%s) permissions are liberal (required: 400, found: %s)' % (self.creds['client_key'], perms))
                 elif self.auth_type == 'x509_proxy':
                     try:
                         self.creds['client_proxy'] = path.abspath(path.expanduser(path.expandvars(config_get('client', 'client_x509_proxy'))))
@@ -246,8 +353,8 @@ class BaseClient(object):
                 if error.args[0] != 'client_key':
                     raise MissingClientParameter('Option \'%s\' cannot be found in config file' % error.args[0])
 
-        rucio_scheme = urlparse(self.host).scheme
-        auth_scheme = urlparse(self.auth_host).scheme
+        rucio_scheme = url_scheme(self.host)
+        auth_scheme = url_scheme(self.auth_host)
 
         if rucio_scheme != 'http' and rucio_scheme != 'https':
             raise ClientProtocolNotSupported('\'%s\' not supported' % rucio_scheme)
@@ -293,7 +400,7 @@ class BaseClient(object):
         # if token file path is defined in the rucio.cfg file, use that file. Currently this prevents authenticating as another user or VO.
         if self.auth_token_file_path:
             self.token_file = self.auth_token_file_path
-            self.token_path = '/'.join(self.token_file.split('/')[:-1])
+            self.token_path = path.dirname(self.token_file)
             self.token_exp_epoch_file = self.token_path + '/' + self.TOKEN_EXP_PREFIX + self.account
         else:
             self.token_path = self.TOKEN_PATH_PREFIX + self.account
@@ -311,6 +418,34 @@ class BaseClient(object):
         except ValueError:
             LOG.debug('request_retries must be an integer. Taking default.')
 
+    def _create_session(self):
+        """
+        Helper method to create a http session with a connection pool, so that subsequent requests
+        reuse the established keep-alive connections instead of doing a new TCP/TLS handshake each time.
+        Failures to establish a connection are retried with backoff inside the adapter, and only there.
+        Nothing has been sent at that point, so this is safe for every http method. The read errors,
+        read timeouts included, and the other errors, as a failed TLS handshake, are raised at once. The
+        retries on the http status code are done in _send_request.
+
+        The client creates a single session, and with it a single adapter and connection pool, which
+        is not shared with other clients, as pooled connections keep the client certificate they were
+        established with.
+
+        :return: the requests session.
+        """
+        max_retries = Retry(total=self.CONNECT_RETRIES, connect=self.CONNECT_RETRIES, read=False, status=False, other=0, backoff_factor=self.CONNECT_BACKOFF_FACTOR)
+        self.adapter = KeepAliveHTTPAdapter(pool_connections=self.POOL_CONNECTIONS, pool_maxsize=self.POOL_MAXSIZE, max_retries=max_retries)
+        session = Session()
+        session.mount('https://', self.adapter)
+        session.mount('http://', self.adapter)
+        return session
+
+    def close(self):
+        """
+        Closes the http session of the client and releases its pooled connections.
+        """
+        self.session.close()
+
     def _get_exception(self, headers, status_code=None, data=None):
         """
         Helper method to parse an error string send by the server and transform it into the corresponding rucio exception.
@@ -321,10 +456,14 @@ class BaseClient(object):
 
         :return: A rucio exception class and an error string.
         """
-        try:
-            data = parse_response(data)
-        except ValueError:
+        if 'ExceptionClass' in headers and _header_message_is_exact(headers.get('ExceptionMessage')):
+            # the server sends the exception in the headers as well, the body is only needed for the messages altered there
             data = {}
+        else:
+            try:
+                data = parse_response(data)
+            except ValueError:
+                data = {}
 
         exc_cls = 'RucioException'
         exc_msg = 'no error information passed (http status code: %s)' % status_code
@@ -348,17 +487,20 @@ class BaseClient(object):
 
         :param response: the response received from the server.
         """
-        if 'content-type' in response.headers and response.headers['content-type'] == 'application/x-json-stream':
-            for line in response.iter_lines():
+        # the media type without parameters like the charset
+        content_type = response.headers.get('content-type', '').split(';', 1)[0].strip()
+        if content_type == 'application/x-json-stream':
+            # the lines are read in large chunks, the default of 512 bytes costs a read call per few lines
+            for line in response.iter_lines(chunk_size=64 * 1024):
                 if line:
                     yield parse_response(line)
-        elif 'content-type' in response.headers and response.headers['content-type'] == 'application/json':
+        elif content_type == 'application/json':
             yield parse_response(response.text)
         else:  # Exception ?
             if response.text:
                 yield response.text
 
-    def _send_request(self, url, headers=None, type_='GET', data=None, params=None, stream=False, get_token=False,
+    def _send_request(self, url, headers=None, type_='GET', data=None, params=None, stream=None, get_token=False,
                       cert=None, auth=None, verify=None):
         """
         Helper method to send requests to the rucio server. Gets a new token and retries if an unauthorized error is returned.
@@ -368,6 +510,8 @@ class BaseClient(object):
         :param type_: the http request type to use.
         :param data: post data.
         :param params: (optional) Dictionary or bytes to be sent in the url query string.
+        :param stream: (optional) if the response body is read lazily. By default only the GET requests which do not
+                       fetch a token are streamed, the body of the other responses is read at once.
         :param get_token: (optional) if it is called from a _get_token function.
         :param cert: (optional) if String, path to the SSL client cert file (.pem). If Tuple, (cert, key) pair.
         :param auth: (optional) auth tuple to enable Basic/Digest/Custom HTTP Auth.
@@ -375,36 +519,60 @@ class BaseClient(object):
                        certificate, or a string, in which case it must be a path to a CA bundle to use.
         :return: the HTTP return body.
         """
-        hds = {'X-Rucio-Auth-Token': self.auth_token, 'X-Rucio-Account': self.account, 'X-Rucio-VO': self.vo,
-               'Connection': 'Keep-Alive', 'User-Agent': self.user_agent,
-               'X-Rucio-Script': self.script_id}
+        if not get_token and not self._refreshing_token and self.__token_expires_soon():
+            with self._token_lock:
+                # another thread may have refreshed the token in the meantime
+                if self.__token_expires_soon():
+                    try:
+                        self.__get_token()
+                    except exception.RucioException as error:
+                        # the current token is still valid, the request is sent with it
+                        LOG.debug('Could not refresh the token before its expiration: %s', error)
+                if self.__token_expires_soon():
+                    # a failed refresh, or a token about to expire as soon as it is received, which means a
+                    # skewed clock, is not tried again before each request, it is left to the 401
+                    self._token_expiration = (self.auth_token, None)
+
+        hds = self.base_headers
+        if hds is None or hds['X-Rucio-Auth-Token'] is not self.auth_token:
+            # built again only when the token changed, the requests without extra headers then share the dict
+            hds = self.base_headers = {'X-Rucio-Auth-Token': self.auth_token, 'X-Rucio-Account': self.account, 'X-Rucio-VO': self.vo,
+                                       'Connection': 'Keep-Alive', 'User-Agent': self.user_agent,
+                                       'X-Rucio-Script': self.script_id}
 
         if headers is not None:
-            hds.update(headers)
+            hds = dict(hds, **headers)
 
         if verify is None:
             verify = self.ca_cert
 
+        if stream is None:
+            # a response read at once gives its connection back to the pool right away
+            stream = type_ == 'GET' and not get_token
+
+        try:
+            method = self.HTTP_METHODS[type_]
+        except KeyError:
+            raise UnsupportedOperation('HTTP request type %s is not supported' % type_)
+
+        # the retries of each kind of failure have their own budget
         result = None
-        for retry in range(self.AUTH_RETRIES + 1):
+        auth_retries = status_retries = connection_retries = 0
+        while True:
             try:
-                if type_ == 'GET':
-                    result = self.session.get(url, headers=hds, verify=verify, timeout=self.timeout, params=params, stream=True, cert=cert, auth=auth)
-                elif type_ == 'PUT':
-                    result = self.session.put(url, headers=hds, data=data, verify=verify, timeout=self.timeout)
-                elif type_ == 'POST':
-                    result = self.session.post(url, headers=hds, data=data, verify=verify, timeout=self.timeout, stream=stream)
-                elif type_ == 'DEL':
-                    result = self.session.delete(url, headers=hds, data=data, verify=verify, timeout=self.timeout)
-                else:
-                    return
-                if result.status_code in STATUS_CODES_TO_RETRY:
-                    back_off(retry, reason='server returned {}'.format(result.status_code))
+                result = self.session.request(method, url, headers=hds, data=data, params=params, verify=verify,
+                                              timeout=self.timeout, stream=stream, cert=cert, auth=auth)
+                if result.status_code in STATUS_CODES_TO_RETRY and status_retries < self.request_retries:
+                    back_off(status_retries, reason='server returned {}'.format(result.status_code), retry_after=result.headers.get('Retry-After'))
+                    status_retries += 1
                     continue
             except ConnectionError as error:
                 LOG.error('ConnectionError: ' + str(error))
-                if retry > self.request_retries:
-                    raise
+                # a MaxRetryError means the adapter already used up its retries to establish the connection
+                if connection_retries >= self.request_retries or (error.args and isinstance(error.args[0], MaxRetryError)):
+                    result = None
+                    break
+                connection_retries += 1
                 continue
             except IOError as error:
                 # Handle Broken Pipe
@@ -412,14 +580,21 @@ class BaseClient(object):
                 if getattr(error, 'errno') != errno.EPIPE:
                     raise
                 LOG.error('BrokenPipe: ' + str(error))
-                if retry > self.request_retries:
-                    raise
+                if connection_retries >= self.request_retries:
+                    result = None
+                    break
+                connection_retries += 1
                 continue
 
-            if result is not None and result.status_code == codes.unauthorized and not get_token:  # pylint: disable-msg=E1101
-                self.session = Session()
-                self.__get_token()
-                hds['X-Rucio-Auth-Token'] = self.auth_token
+            if result.status_code == codes.unauthorized and not get_token and auth_retries < self.AUTH_RETRIES:  # pylint: disable-msg=E1101
+                with self._token_lock:
+                    # another thread may have refreshed the token while this request was in flight
+                    if self.auth_token == hds['X-Rucio-Auth-Token']:
+                        # only the token is stale, keep the session and its pooled connections
+                        self.session.cookies.clear()
+                        self.__get_token()
+                hds = dict(hds, **{'X-Rucio-Auth-Token': self.auth_token})
+                auth_retries += 1
             else:
                 break
 
@@ -427,6 +602,18 @@ class BaseClient(object):
             raise ServerConnectionException
         return result
 
+    def __token_expires_soon(self):
+        """
+        Checks if the current token is a JSON Web Token about to expire, so that it can be refreshed before the
+        server rejects it. The tokens issued by rucio itself carry no expiration and are refreshed on a 401.
+
+        :returns: True if the token expires within TOKEN_EXPIRATION_MARGIN seconds. False otherwise.
+        """
+        token, expiration = self._token_expiration
+        if token is not self.auth_token:
+            token, expiration = self._token_expiration = (self.auth_token, jwt_expiration(self.auth_token))
+        return expiration is not None and expiration - time.time() < self.TOKEN_EXPIRATION_MARGIN
+
     def __get_token_userpass(self):
         """
         Sends a request to get an auth token from the server and stores it as a class attribute. Uses username/password.
@@ -473,49 +660,59 @@ class BaseClient(object):
         :returns: True if the token was successfully received. False otherwise.
         """
 
-        if not self.auth_oidc_refresh_active:
-            return False
-        if path.exists(self.token_exp_epoch_file):
-            with open(self.token_exp_epoch_file, 'r') as token_epoch_file:
+        # the epoch is checked under the lock, so concurrent threads do not all refresh the same token
+        with self._token_lock:
+            if not self.auth_oidc_refresh_active:
+                return False
+            try:
+                epoch_file_mtime = os.stat(self.token_exp_epoch_file).st_mtime
+            except OSError:
+                epoch_file_mtime = None
+            # the epoch file is only read again when it has been rewritten
+            if epoch_file_mtime is not None and epoch_file_mtime != self.token_exp_epoch_file_mtime:
+                self.token_exp_epoch_file_mtime = epoch_file_mtime
+                token_epoch_fd = os.open(self.token_exp_epoch_file, os.O_RDONLY)
                 try:
-                    self.token_exp_epoch = int(token_epoch_file.readline())
-                except:
+                    self.token_exp_epoch = int(os.read(token_epoch_fd, 32))
+                except ValueError:
                     self.token_exp_epoch = None
-
-        if self.token_exp_epoch is None:
-            # check expiration time for a new token
-            pass
-        elif time.time() > self.token_exp_epoch - self.auth_oidc_refresh_before_exp * 60 and time.time() < self.token_exp_epoch:
-            # attempt to refresh token
-            pass
-        else:
-            return False
-
-        request_refresh_url = build_url(self.auth_host, path='auth/oidc_refresh')
-        refresh_result = self._send_request(request_refresh_url, get_token=True)
-        if refresh_result.status_code == codes.ok:
-            if 'X-Rucio-Auth-Token-Expires' not in refresh_result.headers or \
-                    'X-Rucio-Auth-Token' not in refresh_result.headers:
-                print("Rucio Server response does not contain the expected headers.")
+                finally:
+                    os.close(token_epoch_fd)
+
+            if self.token_exp_epoch is None:
+                # check expiration time for a new token
+                pass
+            elif time.time() > self.token_exp_epoch - self.auth_oidc_refresh_before_exp * 60 and time.time() < self.token_exp_epoch:
+                # attempt to refresh token
+                pass
+            else:
                 return False
+
+            request_refresh_url = build_url(self.auth_host, path='auth/oidc_refresh')
+            refresh_result = self._send_request(request_refresh_url, get_token=True)
+            if refresh_result.status_code == codes.ok:
+                if 'X-Rucio-Auth-Token-Expires' not in refresh_result.headers or \
+                        'X-Rucio-Auth-Token' not in refresh_result.headers:
+                    print("Rucio Server response does not contain the expected headers.")
+                    return False
+                else:
+                    new_token = refresh_result.headers['X-Rucio-Auth-Token']
+                    new_exp_epoch = refresh_result.headers['X-Rucio-Auth-Token-Expires']
+                    if new_token and new_exp_epoch:
+                        LOG.debug("Saving token %s and expiration epoch %s to files" % (str(new_token), str(new_exp_epoch)))
+                        # save to the file
+                        self.auth_token = new_token
+                        self.token_exp_epoch = new_exp_epoch
+                        self.__write_token()
+                        self.headers['X-Rucio-Auth-Token'] = self.auth_token
+                        return True
+                    LOG.debug("No new token was received, possibly invalid/expired \
+                               \ntoken or a token with no refresh token in Rucio DB")
+                    return False
             else:
-                new_token = refresh_result.headers['X-Rucio-Auth-Token']
-                new_exp_epoch = refresh_result.headers['X-Rucio-Auth-Token-Expires']
-                if new_token and new_exp_epoch:
-                    LOG.debug("Saving token %s and expiration epoch %s to files" % (str(new_token), str(new_exp_epoch)))
-                    # save to the file
-                    self.auth_token = new_token
-                    self.token_exp_epoch = new_exp_epoch
-                    self.__write_token()
-                    self.headers['X-Rucio-Auth-Token'] = self.auth_token
-                    return True
-                LOG.debug("No new token was received, possibly invalid/expired \
-                           \ntoken or a token with no refresh token in Rucio DB")
+                print("Rucio Client did not succeed to contact the \
+                       \nRucio Auth Server when attempting token refresh.")
                 return False
-        else:
-            print("Rucio Client did not succeed to contact the \
-                   \nRucio Auth Server when attempting token refresh.")
-            return False
 
     def __get_token_OIDC(self):
         """
@@ -566,21 +763,19 @@ class BaseClient(object):
                 print("In the next 3 minutes, Rucio Client will be polling \
                                            \nthe Rucio authentication server for a token.")
                 print("----------------------------------------------")
+                polls = 0
                 while time.time() - start < timeout:
                     result = self._send_request(auth_url, headers=headers, get_token=True)
                     if 'X-Rucio-Auth-Token' in result.headers and result.status_code == codes.ok:
                         break
-                    time.sleep(2)
+                    # the polling slows down from 2s to 10s, a login in the browser rarely takes only a few seconds
+                    time.sleep(min(10, 2 * 1.5 ** polls))
+                    polls += 1
             else:
                 print("Copy paste the code from the browser to the terminal and press enter:")
                 count = 0
                 while count < 3:
-                    # Python3 default
-                    get_input = input
-                    # if Python version <= 2.7 use raw_input
-                    if sys.version_info[:2] <= (2, 7):
-                        get_input = raw_input  # noqa: F821 pylint: disable=undefined-variable
-                    fetchcode = get_input()
+                    fetchcode = input()
                     fetch_url = build_url(self.auth_host, path='auth/oidc_redirect', params=fetchcode)
                     result = self._send_request(fetch_url, headers=headers, get_token=True)
                     if 'X-Rucio-Auth-Token' in result.headers and result.status_code == codes.ok:
@@ -603,27 +798,24 @@ class BaseClient(object):
 
             # if the Rucio OIDC Client configuration does not match the one registered at the Identity Provider
             # the user will get an OAuth error
-            if 'OAuth Error' in result.text:
+            if b'OAuth Error' in result.content:
                 LOG.error('Identity Provider does not allow to proceed. Could be due \
                            \nto misconfigured redirection server name of the Rucio OIDC Client.')
                 return False
             # In case Rucio Client is not authorized to request information about this user yet,
             # it will automatically authorize itself on behalf of the user.
             if result.url == auth_url:
-                form_data = {}
-                for scope_item in oidc_scope.split():
-                    form_data["scope_" + scope_item] = scope_item
-                default_data = {"remember": "until-revoked",
-                                "user_oauth_approval": True,
-                                "authorize": "Authorize"}
-                form_data.update(default_data)
-                print('Automatically authorising request of the following info on behalf of user: %s', str(form_data))
+                form_data = {"scope_" + scope_item: scope_item for scope_item in oidc_scope.split()}
+                form_data.update({"remember": "until-revoked",
+                                  "user_oauth_approval": True,
+                                  "authorize": "Authorize"})
+                print('Automatically authorising request of the following info on behalf of user: %s' % str(form_data))
                 LOG.warning('Automatically authorising request of the following info on behalf of user: %s',
                             str(form_data))
                 # authorizing info request on behalf of the user until he/she revokes this authorization !
                 result = self._send_request(result.url, type_='POST', data=form_data)
 
-        if not result or 'result' not in locals():
+        if not result:
             LOG.error('Cannot retrieve authentication token!')
             return False
 
@@ -642,7 +834,7 @@ class BaseClient(object):
             file_d, file_n = mkstemp(dir=self.token_path)
             with fdopen(file_d, "w") as f_exp_epoch:
                 f_exp_epoch.write(str(self.token_exp_epoch))
-            move(file_n, self.token_exp_epoch_file)
+            rename(file_n, self.token_exp_epoch_file)
             self.__refresh_token_OIDC()
         return True
 
@@ -700,10 +892,11 @@ class BaseClient(object):
         headers = {}
 
         private_key_path = self.creds['ssh_private_key']
-        if not path.exists(private_key_path):
-            LOG.error('given private key (%s) doesn\'t exist' % private_key_path)
-            return False
-        if private_key_path is not None and not path.exists(private_key_path):
+        # the key is read before asking for a challenge, a missing key then costs no request
+        try:
+            with open(private_key_path, 'r') as fd_private_key_path:
+                private_key = fd_private_key_path.read()
+        except (IOError, OSError):
             LOG.error('given private key (%s) doesn\'t exist' % private_key_path)
             return False
 
@@ -725,10 +918,8 @@ class BaseClient(object):
         LOG.debug('got new ssh challenge token \'%s\'' % self.ssh_challenge_token)
 
         # sign the challenge token with the private key
-        with open(private_key_path, 'r') as fd_private_key_path:
-            private_key = fd_private_key_path.read()
-            signature = ssh_sign(private_key, self.ssh_challenge_token)
-            headers['X-Rucio-SSH-Signature'] = signature
+        signature = ssh_sign(private_key, self.ssh_challenge_token)
+        headers['X-Rucio-SSH-Signature'] = signature
 
         url = build_url(self.auth_host, path='auth/ssh')
 
@@ -753,12 +944,14 @@ class BaseClient(object):
 
         :returns: True if the token was successfully received. False otherwise.
         """
-        if not EXTRA_MODULES['requests_kerberos']:
+        # the kerberos modules are only imported by the clients using them
+        requests_kerberos = import_extras(['requests_kerberos'])['requests_kerberos']
+        if not requests_kerberos:
             raise MissingModuleException('The requests-kerberos module is not installed.')
 
         url = build_url(self.auth_host, path='auth/gss')
 
-        result = self._send_request(url, get_token=True, auth=HTTPKerberosAuth())
+        result = self._send_request(url, get_token=True, auth=requests_kerberos.HTTPKerberosAuth())
 
         if not result:
             LOG.error('Cannot retrieve authentication token!')
@@ -790,7 +983,7 @@ class BaseClient(object):
         result = self._send_request(SAML_auth_url, type_='POST', data=userpass, verify=False)
         result = self._send_request(url, get_token=True)
 
-        if not result or 'result' not in locals():
+        if not result:
             LOG.error('Cannot retrieve authentication token!')
             return False
 
@@ -803,44 +996,38 @@ class BaseClient(object):
         self.auth_token = result.headers['X-Rucio-Auth-Token']
         return True
 
+    # auth type -> (method getting a new token, error message if it fails)
+    __TOKEN_GETTERS = {'userpass': (__get_token_userpass, 'userpass authentication failed for account={account} with identity={creds[username]}'),
+                       'x509': (__get_token_x509, 'x509 authentication failed for account={account} with identity={creds}'),
+                       'x509_proxy': (__get_token_x509, 'x509 authentication failed for account={account} with identity={creds}'),
+                       'oidc': (__get_token_OIDC, 'OIDC authentication failed for account={account}'),
+                       'gss': (__get_token_gss, 'kerberos authentication failed for account={account} with identity={creds}'),
+                       'ssh': (__get_token_ssh, 'ssh authentication failed for account={account} with identity={creds}'),
+                       'saml': (__get_token_saml, 'saml authentication failed for account={account} with identity={creds}')}
+
     def __get_token(self):
         """
         Calls the corresponding method to receive an auth token depending on the auth type. To be used if a 401 - Unauthorized error is received.
         """
 
         LOG.debug('get a new token')
-        for retry in range(self.AUTH_RETRIES + 1):
-            if self.auth_type == 'userpass':
-                if not self.__get_token_userpass():
-                    raise CannotAuthenticate('userpass authentication failed for account=%s with identity=%s' % (self.account,
-                                                                                                                 self.creds['username']))
-            elif self.auth_type == 'x509' or self.auth_type == 'x509_proxy':
-                if not self.__get_token_x509():
-                    raise CannotAuthenticate('x509 authentication failed for account=%s with identity=%s' % (self.account,
-                                                                                                             self.creds))
-            elif self.auth_type == 'oidc':
-                if not self.__get_token_OIDC():
-                    raise CannotAuthenticate('OIDC authentication failed for account=%s' % self.account)
-
-            elif self.auth_type == 'gss':
-                if not self.__get_token_gss():
-                    raise CannotAuthenticate('kerberos authentication failed for account=%s with identity=%s' % (self.account,
-                                                                                                                 self.creds))
-            elif self.auth_type == 'ssh':
-                if not self.__get_token_ssh():
-                    raise CannotAuthenticate('ssh authentication failed for account=%s with identity=%s' % (self.account,
-                                                                                                            self.creds))
-            elif self.auth_type == 'saml':
-                if not self.__get_token_saml():
-                    raise CannotAuthenticate('saml authentication failed for account=%s with identity=%s' % (self.account,
-                                                                                                             self.creds))
-            else:
-                raise CannotAuthenticate('auth type \'%s\' not supported' % self.auth_type)
+        # the OIDC and SAML flows send their requests with the token being replaced, which may be about to expire
+        refreshing, self._refreshing_token = self._refreshing_token, True
+        try:
+            for retry in range(self.AUTH_RETRIES + 1):
+                try:
+                    get_token, failure_msg = self.__TOKEN_GETTERS[self.auth_type]
+                except KeyError:
+                    raise CannotAuthenticate('auth type \'%s\' not supported' % self.auth_type)
+                if not get_token(self):
+                    raise CannotAuthenticate(failure_msg.format(account=self.account, creds=self.creds))
 
-            if self.auth_token is not None:
-                self.__write_token()
-                self.headers['X-Rucio-Auth-Token'] = self.auth_token
-                break
+                if self.auth_token is not None:
+                    self.__write_token()
+                    self.headers['X-Rucio-Auth-Token'] = self.auth_token
+                    break
+        finally:
+            self._refreshing_token = refreshing
 
         if self.auth_token is None:
             raise CannotAuthenticate('cannot get an auth token from server')
@@ -855,10 +1042,14 @@ class BaseClient(object):
             return False
 
         try:
-            token_file_handler = open(self.token_file, 'r')
-            self.auth_token = token_file_handler.readline()
+            # the token is a single short line, read with one call and no file object
+            token_fd = os.open(self.token_file, os.O_RDONLY)
+            try:
+                self.auth_token = os.read(token_fd, 64 * 1024).decode('utf-8').split('\n', 1)[0]
+            finally:
+                os.close(token_fd)
             self.headers['X-Rucio-Auth-Token'] = self.auth_token
-        except IOError as error:
+        except (IOError, OSError) as error:
             print("I/O error({0}): {1}".format(error.errno, error.strerror))
         except Exception:
             raise
@@ -884,12 +1075,12 @@ class BaseClient(object):
             file_d, file_n = mkstemp(dir=self.token_path)
             with fdopen(file_d, "w") as f_token:
                 f_token.write(self.auth_token)
-            move(file_n, self.token_file)
+            rename(file_n, self.token_file)
             if self.auth_type == 'oidc' and self.token_exp_epoch and self.auth_oidc_refresh_active:
                 file_d, file_n = mkstemp(dir=self.token_path)
                 with fdopen(file_d, "w") as f_exp_epoch:
                     f_exp_epoch.write(str(self.token_exp_epoch))
-                move(file_n, self.token_exp_epoch_file)
+                rename(file_n, self.token_exp_epoch_file)
         except IOError as error:
             print("I/O error({0}): {1}".format(error.errno, error.strerror))
         except Exception:
@@ -899,28 +1090,15 @@ class BaseClient(object):
         """
         Main method for authentication. It first tries to read a locally saved token. If not available it requests a new one.
         """
-        if self.auth_type == 'userpass':
-            if self.creds['username'] is None or self.creds['password'] is None:
-                raise NoAuthInformation('No username or password passed')
-        elif self.auth_type == 'oidc':
-            if self.creds['oidc_auto'] and (self.creds['oidc_username'] is None or self.creds['oidc_password'] is None):
-                raise NoAuthInformation('For automatic OIDC log-in with your Identity Provider username and password are required.')
-        elif self.auth_type == 'x509':
-            if self.creds['client_cert'] is None:
-                raise NoAuthInformation('The path to the client certificate is required')
-        elif self.auth_type == 'x509_proxy':
-            if self.creds['client_proxy'] is None:
-                raise NoAuthInformation('The client proxy has to be defined')
-        elif self.auth_type == 'ssh':
-            if self.creds['ssh_private_key'] is None:
-                raise NoAuthInformation('The SSH private key has to be defined')
-        elif self.auth_type == 'gss':
-            pass
-        elif self.auth_type == 'saml':
-            if self.creds['username'] is None or self.creds['password'] is None:
-                raise NoAuthInformation('No SAML username or password passed')
-        else:
+        try:
+            required_creds, missing_creds_msg = self.AUTH_REQUIRED_CREDS[self.auth_type]
+        except KeyError:
             raise CannotAuthenticate('auth type \'%s\' not supported' % self.auth_type)
+        if self.auth_type == 'oidc' and not self.creds['oidc_auto']:
+            # the username and password are only needed for the automatic log-in
+            required_creds = ()
+        if any(self.creds[cred] is None for cred in required_creds):
+            raise NoAuthInformation(missing_creds_msg)
 
         if not self.__read_token():
             self.__get_token()
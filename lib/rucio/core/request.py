@@ -41,6 +41,7 @@ import time
 import traceback
 from collections import namedtuple
 from itertools import filterfalse
+from operator import itemgetter
 from typing import TYPE_CHECKING
 
 from six import string_types
@@ -1474,29 +1475,38 @@ def preparer_update_requests(source_iter: "Iterable[RequestResultOrState]", sess
     """
     Update transfer requests according to preparer settings.
     """
+    # (column name, new value) pairs -> ids of the requests to update with these values
+    updates = dict()
     count = 0
     for rws in source_iter:
-        update_dict = dict()
         if isinstance(rws, RequestAndState):
             # special case where the first entry is the request id and the second is the new state
             # (see handling of RequestState.NO_SOURCES in reduce_requests)
             request_id = rws.request_id
-            update_dict[models.Request.state] = rws.request_state
+            update_values = (('state', rws.request_state), )
         else:
             request_id = rws['request_id']
-            update_dict[models.Request.state] = __throttler_request_state(
-                activity=rws['activity'],
-                source_rse_id=rws['src_rse_id'],
-                dest_rse_id=rws['dest_rse_id'],
-                session=session,
+            update_values = (
+                ('state', __throttler_request_state(
+                    activity=rws['activity'],
+                    source_rse_id=rws['src_rse_id'],
+                    dest_rse_id=rws['dest_rse_id'],
+                    session=session,
+                )),
+                ('source_rse_id', rws['src_rse_id']),
             )
-            update_dict[models.Request.source_rse_id] = rws['src_rse_id']
 
             if 'transfertool' in rws:
-                update_dict[models.Request.transfertool] = rws['transfertool']
+                update_values += (('transfertool', rws['transfertool']), )
 
-        session.query(models.Request).filter_by(id=request_id).update(update_dict, synchronize_session=False)
+        updates.setdefault(update_values, []).append(request_id)
         count += 1
+
+    # the requests getting the same values are updated together, with one statement per chunk
+    for update_values, request_ids in updates.items():
+        update_dict = {getattr(models.Request, column): value for column, value in update_values}
+        for request_ids_chunk in chunks(request_ids, 1000):
+            session.query(models.Request).filter(models.Request.id.in_(request_ids_chunk)).update(update_dict, synchronize_session=False)
     return count
 
 
@@ -1584,6 +1594,32 @@ def reduce_requests(
 
 def get_supported_transfertools(rse_id: str, session=None) -> "Set[str]":
     transfertool_attr = get_rse_attribute('transfertool', rse_id=rse_id, session=session)
+    return __transfertools_from_attribute(transfertool_attr)
+
+
+@read_session
+def get_supported_transfertools_bulk(rse_ids: "Iterable[str]", session=None) -> "Dict[str, Set[str]]":
+    """
+    Returns the supported transfertools of several rses, read with one query per
+    chunk of rse ids instead of one lookup per rse.
+
+    :param rse_ids: The rse ids.
+    :param session: The database session in use.
+    :returns:       A dictionary with the set of supported transfertools for each rse id.
+    """
+    rse_ids = list(rse_ids)
+    transfertool_attrs = {}
+    for rse_ids_chunk in chunks(rse_ids, 1000):
+        query = session.query(models.RSEAttrAssociation.rse_id, models.RSEAttrAssociation.value)\
+                       .filter(models.RSEAttrAssociation.key == 'transfertool')\
+                       .filter(models.RSEAttrAssociation.rse_id.in_(rse_ids_chunk))\
+                       .distinct()
+        for rse_id, value in query:
+            transfertool_attrs.setdefault(rse_id, []).append(value)
+    return {rse_id: __transfertools_from_attribute(transfertool_attrs.get(rse_id)) for rse_id in rse_ids}
+
+
+def __transfertools_from_attribute(transfertool_attr: "Optional[List[str]]") -> "Set[str]":
     if transfertool_attr:
         result = set()
         for attr in transfertool_attr:
@@ -1627,7 +1663,7 @@ def get_transfertool_filter(
 
 
 def sort_requests_minimum_distance(items: "RowIterator") -> "RowIterator":
-    yield from sorted(items, key=lambda rws_dict: rws_dict['distance_ranking'])
+    yield from sorted(items, key=itemgetter('distance_ranking'))
 
 
 def rse_lookup_filter(items: "RowIterator") -> "RowIterator":
@@ -279,6 +279,8 @@ class DirectTransferDefinition:
     The class wraps the legacy dict-based transfer definition to maintain compatibility with existing code
     during the migration.
     """
+    __slots__ = ('sources', 'destination', 'rws', 'protocol_factory', 'operation_src', 'operation_dest', 'legacy_def')
+
     def __init__(self, source, destination, rws, protocol_factory, operation_src, operation_dest):
         self.sources = [source]
         self.destination = destination
@@ -513,6 +515,8 @@ class StageinTransferDefinition(DirectTransferDefinition):
         - can only have one source
         - bring_online must be set
     """
+    __slots__ = ()
+
     def __init__(self, source, destination, rws, protocol_factory, operation_src, operation_dest):
         if not source.rse.is_tape() or destination.rse.is_tape():
             raise RucioException("Stageing request {} must be from TAPE to DISK rse. Got {} and {}.".format(rws, source, destination))
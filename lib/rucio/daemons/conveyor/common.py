@@ -262,7 +262,7 @@ def bulk_group_transfers_for_globus(transfer_paths, policy, group_bulk=200):
 
 
 @read_session
-def bulk_group_transfers_for_fts(transfers, policy='rule', group_bulk=200, source_strategy=None, max_time_in_queue=None, session=None, logger=logging.log, archive_timeout_override=None):
+def bulk_group_transfers_for_fts(transfers, policy='rule', group_bulk=200, source_strategy=None, max_time_in_queue=None, session=None, logger=logging.log, archive_timeout_override=None, init_hook=None):
     """
     Group transfers in bulk based on certain criterias
 
@@ -273,6 +273,7 @@ def bulk_group_transfers_for_fts(transfers, policy='rule', group_bulk=200, sourc
     :param max_time_in_queue:        Maximum time in queue
     :param archive_timeout_override: Override the archive_timeout parameter for any transfers with it set (0 to unset)
     :param logger:                   Optional decorated logger that can be passed from the calling daemons or servers.
+    :param init_hook:                Optional function called with each transfer before it is grouped.
     :return:                         List of grouped transfers.
     """
 
@@ -294,6 +295,8 @@ def bulk_group_transfers_for_fts(transfers, policy='rule', group_bulk=200, sourc
         activity_source_strategy = {}
 
     for transfer in chain.from_iterable(transfers):
+        if init_hook:
+            init_hook(transfer)
         verify_checksum, checksums_to_use = transfer_core.checksum_validation_strategy(transfer.src.rse.attributes, transfer.dst.rse.attributes, logger=logger)
         t_file = {'sources': transfer['sources'],
                   'destinations': transfer['dest_urls'],
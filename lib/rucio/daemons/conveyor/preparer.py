@@ -18,11 +18,12 @@
 # - Thomas Beermann <thomas.beermann@cern.ch>, 2021
 # - David Población Criado <david.poblacion.criado@cern.ch>, 2021
 
+import functools
 import logging
 import os
 import socket
 import threading
-from time import time
+from time import monotonic, time
 from typing import TYPE_CHECKING
 
 import rucio.db.sqla.util
@@ -32,7 +33,7 @@ from rucio.common.logging import formatted_logger, setup_logging
 from rucio.common.utils import daemon_sleep
 from rucio.core import heartbeat
 from rucio.core.request import preparer_update_requests, reduce_requests, sort_requests_minimum_distance, \
-    get_transfertool_filter, get_supported_transfertools, rse_lookup_filter
+    get_transfertool_filter, get_supported_transfertools, get_supported_transfertools_bulk, rse_lookup_filter
 from rucio.core.transfer import __list_transfer_requests_and_source_replicas
 from rucio.db.sqla.constants import RequestState
 
@@ -64,17 +65,20 @@ def run(once=False, threads=1, sleep_time=10, bulk=100):
         # not sure if this is needed for threading.Thread, but it always returns a fresh dictionary
         return {'once': once, 'sleep_time': sleep_time, 'bulk': bulk}
 
-    threads = [threading.Thread(target=preparer, name=f'conveyor-preparer-{i}', kwargs=preparer_kwargs(), daemon=True) for i in range(threads)]
+    # set by the first thread to exit, the threads exit on their own after a graceful stop
+    worker_exit = threading.Event()
+
+    def preparer_thread(**kwargs):
+        try:
+            preparer(**kwargs)
+        finally:
+            worker_exit.set()
+
+    threads = [threading.Thread(target=preparer_thread, name=f'conveyor-preparer-{i}', kwargs=preparer_kwargs(), daemon=True) for i in range(threads)]
     for thr in threads:
         thr.start()
 
-    all_running = True
-    while all_running:
-        for thr in threads:
-            thr.join(timeout=3.14)
-            if not thr.is_alive() or graceful_stop.is_set():
-                all_running = False
-                break
+    worker_exit.wait()
 
     if graceful_stop.is_set() or once:
         logging.info('conveyor-preparer: gracefully stopping')
@@ -103,14 +107,19 @@ def preparer(once, sleep_time, bulk):
     try:
         graceful_stop.wait(10)  # gathering of daemons/threads on first start
         while not graceful_stop.is_set():
+            # the wall clock start is what daemon_sleep expects, the duration is measured on the monotonic clock
             start_time = time()
+            start_monotonic = monotonic()
 
             pulse = heartbeat.live(executable=executable, hostname=hostname, pid=pid, thread=current_thread)
             worker_number = pulse['assign_thread']
             total_workers = pulse['nr_threads']
 
-            prefix = 'conveyor-preparer[%s/%s] ' % (worker_number, total_workers)
-            daemon_logger = formatted_logger(logging.log, prefix + '%s')
+            new_prefix = 'conveyor-preparer[%s/%s] ' % (worker_number, total_workers)
+            if new_prefix != prefix:
+                # the worker numbers only change when the threads are rebalanced
+                prefix = new_prefix
+                daemon_logger = formatted_logger(logging.log, prefix + '%s')
 
             try:
                 updated_msg = run_once(total_workers=total_workers, worker_number=worker_number, limit=bulk, logger=daemon_logger)
@@ -121,8 +130,7 @@ def preparer(once, sleep_time, bulk):
             if once:
                 break
 
-            end_time = time()
-            time_diff = end_time - start_time
+            time_diff = monotonic() - start_monotonic
             daemon_logger(logging.INFO, '%s, taking %.3f seconds' % (updated_msg, time_diff))
             daemon_sleep(start_time=start_time, sleep_time=sleep_time, graceful_stop=graceful_stop, logger=daemon_logger)
 
@@ -143,7 +151,13 @@ def run_once(total_workers: int = 0, worker_number: int = 0, limit: "Optional[in
     if not req_sources:
         return 'had nothing to do'
 
-    transfertool_filter = get_transfertool_filter(lambda rse_id: get_supported_transfertools(rse_id=rse_id, session=session))
+    # the transfertools of all the rses of the batch are read at once, any other rse is looked up once
+    rse_ids = {rws.dest_rse.id for rws in req_sources}
+    rse_ids.update(source.rse.id for rws in req_sources for source in rws.sources)
+    rse_ids.discard(None)
+    rse_transfertools = get_supported_transfertools_bulk(rse_ids, session=session)
+    lookup_transfertools = functools.lru_cache(maxsize=None)(lambda rse_id: get_supported_transfertools(rse_id=rse_id, session=session))
+    transfertool_filter = get_transfertool_filter(lambda rse_id: rse_transfertools.get(rse_id) or lookup_transfertools(rse_id))
     requests = reduce_requests(req_sources, [rse_lookup_filter, sort_requests_minimum_distance, transfertool_filter], logger=logger)
     count = preparer_update_requests(requests, session=session)
     return f'updated {count}/{limit} requests'
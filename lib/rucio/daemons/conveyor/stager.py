@@ -31,12 +31,15 @@ Conveyor stager is a daemon to manage stagein file transfers.
 
 from __future__ import division
 
+import functools
+import heapq
 import logging
 import os
 import socket
 import threading
 import time
-from collections import defaultdict
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from six.moves.configparser import NoOptionError
 
@@ -52,13 +55,32 @@ from rucio.db.sqla.constants import RequestType
 
 graceful_stop = threading.Event()
 
+HEARTBEAT_INTERVAL = 30
 
-def stager(once=False, rses=None, bulk=100, group_bulk=1, group_policy='rule',
-           source_strategy=None, activities=None, sleep_time=600, retry_other_fts=False):
+# shared by the stager threads of the process
+submit_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='conveyor-stager-submit')
+
+StagerConfig = namedtuple('StagerConfig', ['scheme', 'failover_scheme', 'bring_online', 'max_time_in_queue'])
+
+
+@functools.lru_cache(maxsize=1)
+def get_hostname():
     """
-    Main loop to submit a new transfer primitive to a transfertool.
+    Resolves the fully qualified name of the host once for all the stager threads of the process.
+
+    :returns: The fully qualified host name.
     """
+    return socket.getfqdn()
 
+
+@functools.lru_cache(maxsize=1)
+def load_stager_config():
+    """
+    Reads the stager options of the conveyor section once for all the stager threads of the process.
+    The max_time_in_queue dictionary is shared between the threads and must not be modified.
+
+    :returns: A StagerConfig tuple.
+    """
     try:
         scheme = config_get('conveyor', 'scheme')
     except NoOptionError:
@@ -87,12 +109,23 @@ def stager(once=False, rses=None, bulk=100, group_bulk=1, group_policy='rule',
         max_time_in_queue['default'] = 168
     logging.debug("Maximum time in queue for different activities: %s" % max_time_in_queue)
 
-    activity_next_exe_time = defaultdict(time.time)
+    return StagerConfig(scheme=scheme, failover_scheme=failover_scheme, bring_online=bring_online, max_time_in_queue=max_time_in_queue)
+
+
+def stager(once=False, rses=None, bulk=100, group_bulk=1, group_policy='rule',
+           source_strategy=None, activities=None, sleep_time=600, retry_other_fts=False):
+    """
+    Main loop to submit a new transfer primitive to a transfertool.
+    """
+
+    scheme, failover_scheme, bring_online, max_time_in_queue = load_stager_config()
+
     executable = 'conveyor-stager'
     if activities:
-        activities.sort()
+        # sorted into a new list, the list of the caller is shared by all the stager threads
+        activities = sorted(activities)
         executable += '--activities ' + str(activities)
-    hostname = socket.getfqdn()
+    hostname = get_hostname()
     pid = os.getpid()
     hb_thread = threading.current_thread()
     heartbeat.sanity_check(executable=executable, hostname=hostname)
@@ -106,69 +139,92 @@ def stager(once=False, rses=None, bulk=100, group_bulk=1, group_policy='rule',
     prefix = 'conveyor-stager[%i/%i] : ' % (heart_beat['assign_thread'], heart_beat['nr_threads'])
     logger = formatted_logger(logging.log, prefix + '%s')
     logger(logging.INFO, 'Stager started')
+    last_heart_beat_time = time.time()
+
+    if not activities:
+        activities = [None]
+    if rses:
+        rse_ids = [rse['id'] for rse in rses]
+    else:
+        rse_ids = None
+
+    # heap of (next execution time, position, activity), the position keeps the order and never compares the activities
+    schedule = [(time.time(), position, activity) for position, activity in enumerate(activities)]
+    heapq.heapify(schedule)
 
     while not graceful_stop.is_set():
 
         try:
-            heart_beat = heartbeat.live(executable, hostname, pid, hb_thread)
-            prefix = 'conveyor-stager[%i/%i] : ' % (heart_beat['assign_thread'], heart_beat['nr_threads'])
-            logger = formatted_logger(logging.log, prefix + '%s')
-
-            if activities is None:
-                activities = [None]
-            if rses:
-                rse_ids = [rse['id'] for rse in rses]
+            # the heartbeat is only sent every HEARTBEAT_INTERVAL, the waits for the activities are capped to it
+            now = time.time()
+            if now - last_heart_beat_time > HEARTBEAT_INTERVAL:
+                heart_beat = heartbeat.live(executable, hostname, pid, hb_thread)
+                last_heart_beat_time = now = time.time()
+                new_prefix = 'conveyor-stager[%i/%i] : ' % (heart_beat['assign_thread'], heart_beat['nr_threads'])
+                if new_prefix != prefix:
+                    # the worker numbers only change when the threads are rebalanced
+                    prefix = new_prefix
+                    logger = formatted_logger(logging.log, prefix + '%s')
+
+            next_exe_time, position, activity = schedule[0]
+            if next_exe_time > now:
+                graceful_stop.wait(min(next_exe_time - now, HEARTBEAT_INTERVAL))
+                continue
+            heapq.heappop(schedule)
+
+            logger(logging.INFO, 'Starting to get stagein transfers for %s' % (activity))
+            start_time = now
+
+            transfers = transfer_core.next_transfers_to_submit(
+                total_workers=heart_beat['nr_threads'],
+                worker_number=heart_beat['assign_thread'],
+                failover_schemes=failover_scheme,
+                limit=bulk,
+                activity=activity,
+                rses=rse_ids,
+                schemes=scheme,
+                retry_other_fts=retry_other_fts,
+                older_than=None,
+                request_type=RequestType.STAGEIN,
+                logger=logger,
+            )
+            if not transfers:
+                # nothing is sent to the monitoring for an idle activity
+                logger(logging.DEBUG, 'Got no stagein transfers for %s, sleep %s seconds' % (activity, sleep_time))
+                next_exe_time = time.time() + sleep_time
             else:
-                rse_ids = None
-
-            for activity in activities:
-                if activity_next_exe_time[activity] > time.time():
-                    graceful_stop.wait(1)
-                    continue
-
-                logger(logging.INFO, 'Starting to get stagein transfers for %s' % (activity))
-                start_time = time.time()
-
-                transfers = transfer_core.next_transfers_to_submit(
-                    total_workers=heart_beat['nr_threads'],
-                    worker_number=heart_beat['assign_thread'],
-                    failover_schemes=failover_scheme,
-                    limit=bulk,
-                    activity=activity,
-                    rses=rse_ids,
-                    schemes=scheme,
-                    retry_other_fts=retry_other_fts,
-                    older_than=None,
-                    request_type=RequestType.STAGEIN,
-                    logger=logger,
-                )
-                total_transfers = len(list(hop for paths in transfers.values() for path in paths for hop in path))
-                record_timer('daemons.conveyor.stager.get_stagein_transfers.per_transfer', (time.time() - start_time) * 1000 / (total_transfers if transfers else 1))
+                total_transfers = sum(len(path) for paths in transfers.values() for path in paths)
+                record_timer('daemons.conveyor.stager.get_stagein_transfers.per_transfer', (time.time() - start_time) * 1000 / (total_transfers or 1))
                 record_counter('daemons.conveyor.stager.get_stagein_transfers', total_transfers)
                 record_timer('daemons.conveyor.stager.get_stagein_transfers.transfers', total_transfers)
                 logger(logging.INFO, 'Got %s stagein transfers for %s' % (total_transfers, activity))
 
+                def init_hop(hop):
+                    hop.init_legacy_transfer_definition(bring_online=bring_online, default_lifetime=-1, logger=logger)
+
                 for external_host, transfer_paths in transfers.items():
                     logger(logging.INFO, 'Starting to group transfers for %s (%s)' % (activity, external_host))
                     start_time = time.time()
-                    for transfer_path in transfer_paths:
-                        for i, hop in enumerate(transfer_path):
-                            hop.init_legacy_transfer_definition(bring_online=bring_online, default_lifetime=-1, logger=logger)
-                    grouped_jobs = bulk_group_transfers_for_fts(transfer_paths, group_policy, group_bulk, source_strategy, max_time_in_queue)
+                    grouped_jobs = bulk_group_transfers_for_fts(transfer_paths, group_policy, group_bulk, source_strategy, max_time_in_queue, init_hook=init_hop)
                     record_timer('daemons.conveyor.stager.bulk_group_transfer', (time.time() - start_time) * 1000 / (len(transfer_paths) or 1))
 
                     logger(logging.INFO, 'Starting to submit transfers for %s (%s)' % (activity, external_host))
-                    for job in grouped_jobs:
-                        submit_transfer(external_host=external_host, job=job, submitter='transfer_submitter', logger=logger)
+                    # the jobs are independent fts submissions, they are sent concurrently and all of them are waited for
+                    list(submit_pool.map(lambda job: submit_transfer(external_host=external_host, job=job, submitter='transfer_submitter', logger=logger), grouped_jobs))
 
+                now = time.time()
                 if total_transfers < group_bulk:
                     logger(logging.INFO, 'Only %s transfers for %s which is less than group bulk %s, sleep %s seconds' % (total_transfers, activity, group_bulk, sleep_time))
-                    if activity_next_exe_time[activity] < time.time():
-                        activity_next_exe_time[activity] = time.time() + sleep_time
+                    next_exe_time = now + sleep_time
+                else:
+                    next_exe_time = now
+            if not once:
+                heapq.heappush(schedule, (next_exe_time, position, activity))
         except Exception:
             raise
 
-        if once:
+        if not schedule:
+            # every activity ran once
             break
 
     logger(logging.INFO, 'Graceful stop requested')
@@ -223,19 +279,31 @@ def run(once=False, total_threads=1, group_bulk=1, group_policy='rule',
 
     else:
         logging.info('starting stager threads')
-        threads = [threading.Thread(target=stager, kwargs={'rses': working_rses,
-                                                           'bulk': bulk,
-                                                           'group_bulk': group_bulk,
-                                                           'group_policy': group_policy,
-                                                           'activities': activities,
-                                                           'sleep_time': sleep_time,
-                                                           'source_strategy': source_strategy,
-                                                           'retry_other_fts': retry_other_fts}) for _ in range(0, total_threads)]
+
+        # set by the first thread to exit, the threads exit on their own after a graceful stop
+        worker_exit = threading.Event()
+
+        def stager_thread(**kwargs):
+            try:
+                stager(**kwargs)
+            finally:
+                worker_exit.set()
+
+        threads = [threading.Thread(target=stager_thread, kwargs={'rses': working_rses,
+                                                                  'bulk': bulk,
+                                                                  'group_bulk': group_bulk,
+                                                                  'group_policy': group_policy,
+                                                                  'activities': activities,
+                                                                  'sleep_time': sleep_time,
+                                                                  'source_strategy': source_strategy,
+                                                                  'retry_other_fts': retry_other_fts}) for _ in range(0, total_threads)]
 
         [thread.start() for thread in threads]
 
         logging.info('waiting for interrupts')
 
-        # Interruptible joins require a timeout.
-        while threads:
-            threads = [thread.join(timeout=3.14) for thread in threads if thread and thread.is_alive()]
+        worker_exit.wait()
+        # a thread which exits without a graceful stop takes the other ones down with it
+        graceful_stop.set()
+        for thread in threads:
+            thread.join()
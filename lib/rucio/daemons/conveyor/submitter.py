@@ -167,7 +167,7 @@ def submitter(once=False, rses=None, partition_wait_time=10,
                     request_type=RequestType.TRANSFER,
                     logger=logger,
                 )
-                total_transfers = len(list(hop for paths in transfers.values() for path in paths for hop in path))
+                total_transfers = sum(len(path) for paths in transfers.values() for path in paths)
 
                 record_timer('daemons.conveyor.transfer_submitter.get_transfers.per_transfer', (time.time() - start_time) * 1000 / (total_transfers or 1))
                 record_counter('daemons.conveyor.transfer_submitter.get_transfers', total_transfers)
@@ -38,7 +38,7 @@ from rucio.db.sqla.constants import DIDType
 from rucio.db.sqla.session import transactional_session
 from rucio.tests.common import file_generator, rse_name_generator
 from six import PY3
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, or_, insert
 
 
 class TemporaryRSEFactory:
@@ -161,6 +161,16 @@ class TemporaryRSEFactory:
         }
         return self._make_rse(scheme='srm', protocol_impl='rucio.rse.protocols.srm.Default', parameters=parameters, add_rse_kwargs=kwargs)
 
+    @transactional_session
+    def add_distances_bulk(self, distances, session=None):
+        """
+        Adds several distances with a single insert statement
+
+        :param distances: A list of (src_rse_id, dest_rse_id, ranking) tuples.
+        """
+        session.execute(insert(models.Distance), [{'src_rse_id': src_rse_id, 'dest_rse_id': dest_rse_id, 'ranking': ranking}
+                                                  for src_rse_id, dest_rse_id, ranking in distances])
+
 
 class TemporaryDidFactory:
     """
@@ -25,13 +25,15 @@
 
 import random
 import string
+import time
 import unittest
 
 import pytest
 
 from rucio.client.accountclient import AccountClient
-from rucio.client.accountlimitclient import AccountLimitClient
+from rucio.client.accountlimitclient import AccountLimitClient, _WriteDedupCache
 from rucio.common.config import config_get_bool
+from rucio.common.exception import UnsupportedOperation
 from rucio.common.types import InternalAccount
 from rucio.core import account_limit
 from rucio.core.account import add_account
@@ -257,3 +259,74 @@ class TestAccountClient(unittest.TestCase):
         self.alclient.delete_global_account_limit(account=self.account.external, rse_expression=rse_exp)
         result = account_limit.get_global_account_limit(account=self.account, rse_expression=rse_exp)
         assert result is None
+
+    def test_set_local_account_limit_write_dedup(self):
+        """ ACCOUNTLIMIT (CLIENTS): Set local account limit twice with write deduplication """
+        alclient = AccountLimitClient(enable_write_dedup=True)
+        alclient.set_local_account_limit(account=self.account.external, rse=self.rse1, bytes_=987)
+        account_limit.set_local_account_limit(account=self.account, rse_id=self.rse1_id, bytes_=1)
+
+        # the second identical write is not sent to the server
+        alclient.set_local_account_limit(account=self.account.external, rse=self.rse1, bytes_=987)
+        assert account_limit.get_local_account_limit(account=self.account, rse_id=self.rse1_id) == 1
+
+        # deleting the limit forgets the last written value
+        alclient.delete_local_account_limit(account=self.account.external, rse=self.rse1)
+        alclient.set_local_account_limit(account=self.account.external, rse=self.rse1, bytes_=987)
+        assert account_limit.get_local_account_limit(account=self.account, rse_id=self.rse1_id) == 987
+        account_limit.delete_local_account_limit(account=self.account, rse_id=self.rse1_id)
+
+    def test_set_and_delete_account_limits_bulk(self):
+        """ ACCOUNTLIMIT (CLIENTS): Set and delete account limits in bulk """
+        results = self.alclient.set_account_limits_bulk([(self.account.external, self.rse1, 100, 'local'),
+                                                         (self.account.external, self.rse2, 200, 'local'),
+                                                         (self.account.external, 'MOCK', 300, 'global'),
+                                                         (self.account.external, self.rse1, 400, 'wrong')])
+        assert results[:3] == [True, True, True]
+        assert isinstance(results[3], UnsupportedOperation)
+        assert account_limit.get_local_account_limit(account=self.account, rse_id=self.rse1_id) == 100
+        assert account_limit.get_local_account_limit(account=self.account, rse_id=self.rse2_id) == 200
+        assert account_limit.get_global_account_limit(account=self.account, rse_expression='MOCK') == 300
+
+        results = self.alclient.delete_account_limits_bulk([(self.account.external, self.rse1, 'local'),
+                                                            (self.account.external, self.rse2, 'local'),
+                                                            (self.account.external, 'MOCK', 'global')])
+        assert results == [True, True, True]
+        assert account_limit.get_local_account_limit(account=self.account, rse_id=self.rse1_id) is None
+        assert account_limit.get_local_account_limit(account=self.account, rse_id=self.rse2_id) is None
+        assert account_limit.get_global_account_limit(account=self.account, rse_expression='MOCK') is None
+
+
+def test_write_dedup_cache_is_bounded():
+    """ ACCOUNTLIMIT (CLIENTS): The write deduplication cache evicts the oldest and the expired entries """
+    cache = _WriteDedupCache(maxsize=3, expiration_time=10)
+    for bytes_ in range(5):
+        cache.set('local:account:rse%d' % bytes_, bytes_)
+    assert len(cache) == 3
+    assert cache.get('local:account:rse0') is None
+    assert cache.get('local:account:rse4') == 4
+
+    # writing a key again makes it the newest entry
+    cache.set('local:account:rse2', 20)
+    cache.set('local:account:rse5', 5)
+    assert cache.get('local:account:rse2') == 20
+    assert cache.get('local:account:rse3') is None
+
+    cache.delete('local:account:rse2')
+    assert cache.get('local:account:rse2') is None
+
+    cache = _WriteDedupCache(maxsize=3, expiration_time=0.1)
+    cache.set('local:account:rse0', 0)
+    time.sleep(0.2)
+    assert cache.get('local:account:rse0') is None
+    cache.set('local:account:rse1', 1)
+    cache.set('local:account:rse2', 2)
+    time.sleep(0.2)
+    cache.set('local:account:rse3', 3)
+    assert len(cache) == 1
+
+    # with no expiration time, nothing is kept
+    cache = _WriteDedupCache(maxsize=3, expiration_time=0)
+    cache.set('local:account:rse0', 0)
+    assert len(cache) == 0
+    assert cache.get('local:account:rse0') is None
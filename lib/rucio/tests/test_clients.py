@@ -40,15 +40,24 @@ try:
     from SocketServer import TCPServer as HTTPServer
 except ImportError:
     from http.server import HTTPServer
+import base64
+import errno
+import json
+import socket
+import time
+from email.utils import formatdate
 from os import remove
-from threading import Thread
+from threading import Event, Thread
+from unittest import mock
 
 import pytest
+from requests import Response
+from requests.exceptions import ConnectionError, ReadTimeout
 
-from rucio.client.baseclient import BaseClient
+from rucio.client.baseclient import BaseClient, back_off, MAX_RETRY_BACK_OFF_SECONDS
 from rucio.client.client import Client
 from rucio.common.config import config_get, config_get_bool
-from rucio.common.exception import CannotAuthenticate, ClientProtocolNotSupported, RucioException
+from rucio.common.exception import CannotAuthenticate, ClientProtocolNotSupported, DataIdentifierNotFound, RucioException, ServerConnectionException
 from rucio.common.utils import get_tmp_dir
 from rucio.tests.common import get_long_vo
 
@@ -90,6 +99,195 @@ class MockServer:
         return 'http://{}:{}'.format(name, port)
 
 
+@pytest.mark.parametrize("retry_after,min_sleep,max_sleep", [
+    # a number of seconds is honoured, up to the maximum back off
+    ('3', 3, 3),
+    ('0', 0, 0),
+    ('3600', MAX_RETRY_BACK_OFF_SECONDS, MAX_RETRY_BACK_OFF_SECONDS),
+    # an HTTP date is turned into the time left until then, a date in the past means no wait
+    (formatdate(time.time() + 8, usegmt=True), 5, 8),
+    (formatdate(time.time() - 60, usegmt=True), 0, 0),
+    # a missing or malformed value falls back to the jittered back off of the retry, here 0.25 * 2 ** 2 seconds
+    (None, 0.5, 1),
+    ('soon', 0.5, 1),
+    ('-5', 0.5, 1),
+    ('Mon, 99 Foo 2021 25:00:00 GMT', 0.5, 1),
+])
+def test_back_off_retry_after(retry_after, min_sleep, max_sleep):
+    """ CLIENTS (BASECLIENT): The back off honours a valid Retry-After header and ignores a malformed one """
+    with mock.patch('rucio.client.baseclient.time.sleep') as sleep:
+        back_off(2, reason='test', retry_after=retry_after)
+    sleep_time, = sleep.call_args[0]
+    assert min_sleep <= sleep_time <= max_sleep
+
+
+@pytest.fixture
+def offline_client():
+    """
+    A client which skips the authentication, its requests only reach the servers or the sessions mocked by the tests.
+    """
+    with mock.patch.object(BaseClient, '_BaseClient__authenticate'):
+        client = BaseClient(rucio_host='http://localhost', auth_host='http://localhost', account='root', auth_type='userpass',
+                            creds={'username': 'ddmlab', 'password': 'secret'}, vo='def')
+    client.auth_token = 'sometoken'
+    yield client
+    client.close()
+
+
+def test_read_timeout_is_not_retried(offline_client):
+    """ CLIENTS (BASECLIENT): A read timeout is raised at once, the request is not sent again """
+    invocations = []
+
+    class AnswersTooLate(MockServer.Handler):
+        def do_DELETE(self, invocations=invocations):
+            invocations.append(self.path)
+            Event().wait(1)
+
+    offline_client.timeout = 0.2
+    with MockServer(AnswersTooLate) as server:
+        with pytest.raises(ReadTimeout):
+            offline_client._send_request(server.base_url, type_='DEL')  # noqa
+    assert len(invocations) == 1
+
+
+def test_connection_failure_is_retried_by_the_adapter_only(offline_client):
+    """ CLIENTS (BASECLIENT): A failure to connect is retried inside the adapter, not again by _send_request """
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        url = 'http://{}:{}'.format(*sock.getsockname())
+
+    with mock.patch.object(offline_client.session, 'request', wraps=offline_client.session.request) as request, \
+            mock.patch('urllib3.util.retry.Retry.sleep') as adapter_sleep:
+        with pytest.raises(ServerConnectionException):
+            offline_client._send_request(url)  # noqa
+    assert request.call_count == 1
+    assert adapter_sleep.call_count == BaseClient.CONNECT_RETRIES
+
+
+def test_tls_handshake_failure_is_not_retried(offline_client):
+    """ CLIENTS (BASECLIENT): A failed TLS handshake is not a failure to connect, it is raised at once """
+    with MockServer(MockServer.Handler) as server:
+        # a plain http server answers the TLS client hello with a http error
+        url = server.base_url.replace('http://', 'https://')
+        with mock.patch.object(offline_client.session, 'request', wraps=offline_client.session.request) as request, \
+                mock.patch('urllib3.util.retry.Retry.sleep') as adapter_sleep:
+            with pytest.raises(ServerConnectionException):
+                offline_client._send_request(url)  # noqa
+    assert request.call_count == 1
+    assert adapter_sleep.call_count == 0
+
+
+def mock_response(status_code):
+    response = Response()
+    response.status_code = status_code
+    return response
+
+
+@pytest.mark.parametrize("outcome", [
+    ConnectionError('Connection aborted.'),
+    IOError(errno.EPIPE, 'Broken pipe'),
+])
+def test_connection_retries_budget(offline_client, outcome):
+    """ CLIENTS (BASECLIENT): A request failing on the connection is sent request_retries more times, then given up """
+    with mock.patch.object(offline_client.session, 'request', side_effect=outcome) as request:
+        with pytest.raises(ServerConnectionException):
+            offline_client._send_request('http://localhost')  # noqa
+    assert request.call_count == offline_client.request_retries + 1
+
+
+def test_status_retries_budget(offline_client):
+    """ CLIENTS (BASECLIENT): A request answered with 503 is sent request_retries more times, then the last answer is returned """
+    with mock.patch.object(offline_client.session, 'request', side_effect=lambda *args, **kwargs: mock_response(503)) as request, \
+            mock.patch('rucio.client.baseclient.time.sleep'):
+        result = offline_client._send_request('http://localhost')  # noqa
+    assert result.status_code == 503
+    assert request.call_count == offline_client.request_retries + 1
+
+
+def test_auth_retries_budget(offline_client):
+    """ CLIENTS (BASECLIENT): A request answered with 401 gets a new token AUTH_RETRIES times, then the last answer is returned """
+    with mock.patch.object(offline_client.session, 'request', side_effect=lambda *args, **kwargs: mock_response(401)) as request, \
+            mock.patch.object(BaseClient, '_BaseClient__get_token') as get_token:
+        result = offline_client._send_request('http://localhost')  # noqa
+    assert result.status_code == 401
+    assert get_token.call_count == BaseClient.AUTH_RETRIES
+    assert request.call_count == BaseClient.AUTH_RETRIES + 1
+
+
+def test_retries_budgets_are_separate(offline_client):
+    """ CLIENTS (BASECLIENT): The status, connection and auth failures of a request each use their own retries """
+    retries = offline_client.request_retries
+    outcomes = [mock_response(503)] * retries + [ConnectionError('Connection aborted.')] * retries + [mock_response(401)] * BaseClient.AUTH_RETRIES + [mock_response(200)]
+    with mock.patch.object(offline_client.session, 'request', side_effect=outcomes) as request, \
+            mock.patch.object(BaseClient, '_BaseClient__get_token'), \
+            mock.patch('rucio.client.baseclient.time.sleep'):
+        result = offline_client._send_request('http://localhost')  # noqa
+    assert result.status_code == 200
+    assert request.call_count == len(outcomes)
+
+
+def mock_jwt(expiration):
+    payload = base64.urlsafe_b64encode(json.dumps({'exp': int(expiration)}).encode()).decode().rstrip('=')
+    return 'header.{}.signature'.format(payload)
+
+
+def test_token_refreshed_before_expiration(offline_client):
+    """ CLIENTS (BASECLIENT): A token about to expire is refreshed once before the request, also when the token flow sends requests itself """
+    old_token, new_token = mock_jwt(time.time() + 10), mock_jwt(time.time() + 3600)
+    sent_tokens = []
+
+    def request(method, url, headers=None, **kwargs):
+        sent_tokens.append((url, headers['X-Rucio-Auth-Token']))
+        return mock_response(200)
+
+    def get_token_oidc_auto(client):
+        # like the automatic OIDC log-in, ask the identity provider without get_token while holding the old token
+        client._send_request('http://localhost/idp', type_='POST')  # noqa
+        client.auth_token = new_token
+        return True
+
+    offline_client.auth_type = 'oidc'
+    offline_client.auth_token = old_token
+    with mock.patch.object(offline_client.session, 'request', side_effect=request), \
+            mock.patch.dict(BaseClient._BaseClient__TOKEN_GETTERS, {'oidc': (get_token_oidc_auto, 'OIDC authentication failed')}), \
+            mock.patch.object(BaseClient, '_BaseClient__write_token'):
+        offline_client._send_request('http://localhost/ping')  # noqa
+        offline_client._send_request('http://localhost/ping')  # noqa
+    assert sent_tokens == [('http://localhost/idp', old_token), ('http://localhost/ping', new_token), ('http://localhost/ping', new_token)]
+
+
+def test_token_refresh_failure_before_expiration(offline_client):
+    """ CLIENTS (BASECLIENT): A token about to expire which cannot be refreshed is still used, the refresh is left to the 401 """
+    old_token = mock_jwt(time.time() + 45)
+    get_token = mock.Mock(return_value=False)
+
+    offline_client.auth_type = 'oidc'
+    offline_client.auth_token = old_token
+    with mock.patch.object(offline_client.session, 'request', return_value=mock_response(200)) as request, \
+            mock.patch.dict(BaseClient._BaseClient__TOKEN_GETTERS, {'oidc': (get_token, 'OIDC authentication failed')}):
+        offline_client._send_request('http://localhost/ping')  # noqa
+        offline_client._send_request('http://localhost/ping')  # noqa
+    assert get_token.call_count == 1
+    assert [kwargs['headers']['X-Rucio-Auth-Token'] for _, kwargs in request.call_args_list] == [old_token, old_token]
+
+
+@pytest.mark.parametrize("header_message,body_message,expected_message", [
+    # a message without spaces cannot have been altered in the headers, the body is not needed
+    ('DataIdentifierNotFound', None, 'DataIdentifierNotFound'),
+    # the line breaks of a message are replaced by spaces in the headers, the body keeps them
+    ('first line second line', 'first line\nsecond line', 'first line\nsecond line'),
+    # a long message is truncated in the headers
+    ('x' * 125 + '...', 'x' * 200, 'x' * 200),
+])
+def test_get_exception_headers(offline_client, header_message, body_message, expected_message):
+    """ CLIENTS (BASECLIENT): The exception is taken from the headers only if they carry its exact message """
+    headers = {'ExceptionClass': 'DataIdentifierNotFound', 'ExceptionMessage': header_message}
+    body = json.dumps({'ExceptionClass': 'DataIdentifierNotFound', 'ExceptionMessage': body_message}) if body_message else None
+    exc_cls, exc_msg = offline_client._get_exception(headers=headers, status_code=404, data=body)  # noqa
+    assert exc_cls is DataIdentifierNotFound
+    assert exc_msg == expected_message
+
+
 @pytest.mark.noparallel(reason='fails when run in parallel')
 class TestBaseClient(unittest.TestCase):
     """ To test Clients"""
@@ -185,8 +383,8 @@ class TestBaseClient(unittest.TestCase):
             client = BaseClient(rucio_host=server.base_url, auth_host=server.base_url, account='root', auth_type='userpass', creds=creds, **self.vo)
             del invocations[:]
             client._send_request(server.base_url)  # noqa
-        # The client did back-off multiple times before succeeding: 2 * 0.25s (authentication) + 2 * 0.25s (request) = 1s
-        assert datetime.now() - start_time > timedelta(seconds=0.9)
+        # The client did back-off multiple times before succeeding: at least 0.125s + 0.25s (authentication) + 0.125s + 0.25s (request) = 0.75s
+        assert datetime.now() - start_time > timedelta(seconds=0.7)
 
 
 class TestRucioClients(unittest.TestCase):
@@ -26,7 +26,8 @@ from rucio.core import config as rucio_config
 from rucio.core.did import add_did, delete_dids
 from rucio.core.distance import get_distances, add_distance
 from rucio.core.replica import add_replicas, delete_replicas
-from rucio.core.request import sort_requests_minimum_distance, get_transfertool_filter, get_supported_transfertools
+from rucio.core.request import sort_requests_minimum_distance, get_transfertool_filter, get_supported_transfertools, \
+    get_supported_transfertools_bulk
 from rucio.core.rse import set_rse_transfer_limits, add_rse, del_rse, add_rse_attribute
 from rucio.core.transfer import __list_transfer_requests_and_source_replicas
 from rucio.daemons.conveyor import preparer
@@ -358,3 +359,11 @@ def test_get_supported_transfertools_default(vo, db_session):
     assert len(transfertools) == 2
     assert 'fts3' in transfertools
     assert 'globus' in transfertools
+
+
+def test_get_supported_transfertools_bulk(vo, db_session):
+    with GeneratedRSE(vo=vo, db_session=db_session) as default_rse, \
+            GeneratedRSE(vo=vo, db_session=db_session, setup_func=lambda self: add_rse_attribute(self.rse_id, 'transfertool', 'globus', session=self.db_session)) as attr_rse:
+        transfertools = get_supported_transfertools_bulk([default_rse.rse_id, attr_rse.rse_id], session=db_session)
+
+    assert transfertools == {default_rse.rse_id: {'fts3', 'globus'}, attr_rse.rse_id: {'globus'}}
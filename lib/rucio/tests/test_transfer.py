@@ -17,6 +17,7 @@
 # - Radu Carpa <radu.carpa@cern.ch>, 2021
 
 import pytest
+from sqlalchemy import update
 
 from rucio.common.exception import NoDistance
 from rucio.core.distance import add_distance
@@ -31,7 +32,15 @@ from rucio.db.sqla.session import transactional_session
 from rucio.common.utils import generate_uuid
 
 
-def test_get_hops(rse_factory):
+@pytest.fixture(scope='module')
+def hops_graph(vo):
+    """
+    Builds the distance graph used by test_get_hops once per module
+
+    :return: The list of the ids of the RSEs, in the order of the topology below
+    """
+    from rucio.tests.temp_factories import TemporaryRSEFactory
+
     # Build the following topology:
     # +------+           +------+     10    +------+
     # |      |     40    |      +-----------+      |
@@ -50,96 +59,71 @@ def test_get_hops(rse_factory):
     #      |                50                |
     #      +----------------------------------+
     #
-    _, rse0_id = rse_factory.make_mock_rse()
-    _, rse1_id = rse_factory.make_mock_rse()
-    _, rse2_id = rse_factory.make_mock_rse()
-    _, rse3_id = rse_factory.make_mock_rse()
-    _, rse4_id = rse_factory.make_mock_rse()
-    _, rse5_id = rse_factory.make_mock_rse()
-    _, rse6_id = rse_factory.make_mock_rse()
-    all_rses = [rse0_id, rse1_id, rse2_id, rse3_id, rse4_id, rse5_id, rse6_id]
+    with TemporaryRSEFactory(vo=vo) as rse_factory:
+        rse0_id, rse1_id, rse2_id, rse3_id, rse4_id, rse5_id, rse6_id = rse_ids = [rse_factory.make_mock_rse()[1] for _ in range(7)]
 
-    add_distance(rse1_id, rse3_id, ranking=40)
-    add_distance(rse1_id, rse2_id, ranking=10)
+        rse_factory.add_distances_bulk([
+            (rse1_id, rse3_id, 40),
+            (rse1_id, rse2_id, 10),
 
-    add_distance(rse2_id, rse1_id, ranking=10)
-    add_distance(rse2_id, rse4_id, ranking=10)
+            (rse2_id, rse1_id, 10),
+            (rse2_id, rse4_id, 10),
 
-    add_distance(rse3_id, rse1_id, ranking=40)
-    add_distance(rse3_id, rse4_id, ranking=10)
-    add_distance(rse3_id, rse5_id, ranking=50)
+            (rse3_id, rse1_id, 40),
+            (rse3_id, rse4_id, 10),
+            (rse3_id, rse5_id, 50),
 
-    add_distance(rse4_id, rse2_id, ranking=10)
-    add_distance(rse4_id, rse5_id, ranking=10)
+            (rse4_id, rse2_id, 10),
+            (rse4_id, rse5_id, 10),
 
-    add_distance(rse5_id, rse3_id, ranking=50)
-    add_distance(rse5_id, rse4_id, ranking=10)
-    add_distance(rse5_id, rse6_id, ranking=20)
+            (rse5_id, rse3_id, 50),
+            (rse5_id, rse4_id, 10),
+            (rse5_id, rse6_id, 20),
+        ])
 
-    # There must be no paths between an isolated node and other nodes; be it with multipath enabled or disabled
-    with pytest.raises(NoDistance):
-        get_hops(source_rse_id=rse0_id, dest_rse_id=rse1_id)
-    with pytest.raises(NoDistance):
-        get_hops(source_rse_id=rse1_id, dest_rse_id=rse0_id)
-    with pytest.raises(NoDistance):
-        get_hops(source_rse_id=rse0_id, dest_rse_id=rse1_id, multihop_rses=all_rses)
-    with pytest.raises(NoDistance):
-        get_hops(source_rse_id=rse1_id, dest_rse_id=rse0_id, multihop_rses=all_rses)
+        yield rse_ids
 
-    # A single hop path must be found between two directly connected RSE
-    [hop] = get_hops(source_rse_id=rse1_id, dest_rse_id=rse2_id)
-    assert hop['source_rse_id'] == rse1_id
-    assert hop['dest_rse_id'] == rse2_id
 
-    # No path will be found if there is no direct connection and "include_multihop" is not set
-    with pytest.raises(NoDistance):
-        get_hops(source_rse_id=rse3_id, dest_rse_id=rse2_id)
+ALL_RSES = list(range(7))
 
-    # No multihop rses given, multihop disabled
-    with pytest.raises(NoDistance):
-        get_hops(source_rse_id=rse3_id, dest_rse_id=rse2_id, multihop_rses=[])
 
+@pytest.mark.parametrize("src,dst,multihop_rses,expected_path", [
+    # There must be no paths between an isolated node and other nodes; be it with multipath enabled or disabled
+    (0, 1, None, None),
+    (1, 0, None, None),
+    (0, 1, ALL_RSES, None),
+    (1, 0, ALL_RSES, None),
+    # A single hop path must be found between two directly connected RSE
+    (1, 2, None, [1, 2]),
+    # No path will be found if there is no direct connection and "include_multihop" is not set
+    (3, 2, None, None),
+    # No multihop rses given, multihop disabled
+    (3, 2, [], None),
     # The shortest multihop path will be computed
-    [hop1, hop2] = get_hops(source_rse_id=rse3_id, dest_rse_id=rse2_id, multihop_rses=all_rses)
-    assert hop1['source_rse_id'] == rse3_id
-    assert hop1['dest_rse_id'] == rse4_id
-    assert hop2['source_rse_id'] == rse4_id
-    assert hop2['dest_rse_id'] == rse2_id
-
+    (3, 2, ALL_RSES, [3, 4, 2]),
     # multihop_rses doesn't contain the RSE needed for the shortest path. Return a longer path
-    [hop1, hop2] = get_hops(source_rse_id=rse1_id, dest_rse_id=rse4_id, multihop_rses=[rse3_id])
-    assert hop1['source_rse_id'] == rse1_id
-    assert hop1['dest_rse_id'] == rse3_id
-    assert hop2['source_rse_id'] == rse3_id
-    assert hop2['dest_rse_id'] == rse4_id
-
+    (1, 4, [3], [1, 3, 4]),
     # A link with cost only in one direction will not be used in the opposite direction
-    with pytest.raises(NoDistance):
-        get_hops(source_rse_id=rse6_id, dest_rse_id=rse5_id, multihop_rses=all_rses)
-    [hop1, hop2] = get_hops(source_rse_id=rse4_id, dest_rse_id=rse3_id, multihop_rses=all_rses)
-    assert hop1['source_rse_id'] == rse4_id
-    assert hop2['source_rse_id'] == rse5_id
-    assert hop2['dest_rse_id'] == rse3_id
-
+    (6, 5, ALL_RSES, None),
+    (4, 3, ALL_RSES, [4, 5, 3]),
     # A longer path is preferred over a shorter one with high intermediate cost
-    [hop1, hop2, hop3] = get_hops(source_rse_id=rse3_id, dest_rse_id=rse6_id, multihop_rses=all_rses)
-    assert hop1['source_rse_id'] == rse3_id
-    assert hop2['source_rse_id'] == rse4_id
-    assert hop3['source_rse_id'] == rse5_id
-    assert hop3['dest_rse_id'] == rse6_id
-
+    (3, 6, ALL_RSES, [3, 4, 5, 6]),
     # A link with no cost is ignored. Both for direct connection and multihop paths
-    [hop1, hop2, hop3] = get_hops(source_rse_id=rse2_id, dest_rse_id=rse6_id, multihop_rses=all_rses)
-    assert hop1['source_rse_id'] == rse2_id
-    assert hop2['source_rse_id'] == rse4_id
-    assert hop3['source_rse_id'] == rse5_id
-    assert hop3['dest_rse_id'] == rse6_id
-    [hop1, hop2, hop3, hop4] = get_hops(source_rse_id=rse1_id, dest_rse_id=rse6_id, multihop_rses=all_rses)
-    assert hop1['source_rse_id'] == rse1_id
-    assert hop2['source_rse_id'] == rse2_id
-    assert hop3['source_rse_id'] == rse4_id
-    assert hop4['source_rse_id'] == rse5_id
-    assert hop4['dest_rse_id'] == rse6_id
+    (2, 6, ALL_RSES, [2, 4, 5, 6]),
+    (1, 6, ALL_RSES, [1, 2, 4, 5, 6]),
+])
+def test_get_hops(hops_graph, src, dst, multihop_rses, expected_path):
+    kwargs = {}
+    if multihop_rses is not None:
+        kwargs['multihop_rses'] = [hops_graph[i] for i in multihop_rses]
+
+    if expected_path is None:
+        with pytest.raises(NoDistance):
+            get_hops(source_rse_id=hops_graph[src], dest_rse_id=hops_graph[dst], **kwargs)
+        return
+
+    hops = get_hops(source_rse_id=hops_graph[src], dest_rse_id=hops_graph[dst], **kwargs)
+    assert [(hop['source_rse_id'], hop['dest_rse_id']) for hop in hops] == [(hops_graph[i], hops_graph[j]) for i, j in zip(expected_path, expected_path[1:])]
 
 
 def test_disk_vs_tape_priority(rse_factory, root_account, mock_scope):
@@ -166,7 +150,11 @@ def test_disk_vs_tape_priority(rse_factory, root_account, mock_scope):
 
     @transactional_session
     def __fake_source_ranking(source_rse_id, new_ranking, session=None):
-        rowcount = session.query(models.Source).filter(models.Source.rse_id == source_rse_id).update({'ranking': new_ranking})
+        stmt = update(models.Source).\
+            where(models.Source.rse_id == source_rse_id).\
+            execution_options(synchronize_session=False).\
+            values(ranking=new_ranking)
+        rowcount = session.execute(stmt).rowcount
         if not rowcount:
             models.Source(request_id=request['id'],
                           scope=request['scope'],